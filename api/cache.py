@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import warnings
+
+import requests
+
+from api.fetch import request
+from api.metrics import cache_requests
+
+definition_cache = {
+    "directory": os.environ.get("LEVEKAR_CACHE_DIR", os.path.join(".cache", "sheets")),
+    "ttl": 24 * 60 * 60,  # seconds before an entry is revalidated against the server
+    "max_bytes": 64 * 1024 * 1024,  # size of the cache before the least recently used entries are removed
+    "offline": os.environ.get("LEVEKAR_OFFLINE", "") not in ("", "0"),  # never use the network
+}
+
+_eviction_lock = threading.Lock()
+
+
+class CacheMiss(LookupError):
+    """Raised in offline mode when an entry is not in the cache"""
+
+
+def entry_name(*key) -> str:
+    """Name of the cache entry of `key`, e.g. entry_name(spreadsheet_key, sheet, cell_range)"""
+    return hashlib.sha256("\x1f".join(str(k) for k in key).encode("utf-8")).hexdigest()
+
+
+def _paths(name: str) -> tuple[str, str]:
+    directory = definition_cache["directory"]
+    return os.path.join(directory, name + ".bin"), os.path.join(directory, name + ".json")
+
+
+def write_atomic(path: str, content: bytes):
+    """Replace the file `path` by `content` at once: the readers see the old or the new content, never a part"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_entry(name: str) -> tuple[bytes, dict] | None:
+    """Return the content and the metadata of the entry `name`, None if it is not in the cache"""
+    content_path, meta_path = _paths(name)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(content_path, "rb") as f:
+            content = f.read()
+    except (OSError, ValueError):
+        return None
+    os.utime(content_path)  # the modification time of the content is the last use of the entry
+    return content, meta
+
+
+def write_entry(name: str, content: bytes, meta: dict):
+    """Write the entry `name` in the cache, then remove the least recently used entries above `max_bytes`"""
+    os.makedirs(definition_cache["directory"], exist_ok=True)
+    content_path, meta_path = _paths(name)
+    write_atomic(content_path, content)
+    write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+    evict(definition_cache["max_bytes"])
+
+
+def evict(max_bytes: int):
+    """Remove the least recently used entries until the cache holds less than `max_bytes`"""
+    directory = definition_cache["directory"]
+    with _eviction_lock:
+        entries = []
+        for file in os.scandir(directory):
+            if file.name.endswith(".bin"):
+                stat = file.stat()
+                entries.append((stat.st_mtime, stat.st_size, file.name[:-len(".bin")]))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= max_bytes:
+                break
+            for path in _paths(name):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
+def cached_download(url: str, *key) -> bytes:
+    """Download `url` through the on-disk cache, the entry is identified by `key`
+
+    A fresh entry (younger than `ttl`) is returned without any request. A stale entry is revalidated with
+    If-None-Match / If-Modified-Since, and is still returned if the server can't be reached.
+    In offline mode only the cache is used.
+
+    Parameters
+        ----------
+        url : str
+            The url to download
+        key : tuple
+            Identify the entry, e.g. (spreadsheet key, sheet, range)
+
+    Return
+        ---------
+        The body of the response or of the cached snapshot
+    """
+    name = entry_name(*key)
+    entry = read_entry(name)
+    if definition_cache["offline"]:
+        if entry is None:
+            cache_requests.inc(result="offline_miss")
+            raise CacheMiss(f"{key} is not in the cache ({definition_cache['directory']}) and offline mode is on")
+        cache_requests.inc(result="offline_hit")
+        return entry[0]
+    if entry is not None and time.time() - entry[1]["fetched_at"] < definition_cache["ttl"]:
+        cache_requests.inc(result="hit")
+        return entry[0]
+
+    headers = {}
+    if entry is not None:
+        if entry[1].get("etag"):
+            headers["If-None-Match"] = entry[1]["etag"]
+        if entry[1].get("last_modified"):
+            headers["If-Modified-Since"] = entry[1]["last_modified"]
+    try:
+        response = request(url, headers=headers)
+    except requests.RequestException as e:
+        if entry is None:
+            cache_requests.inc(result="failure")
+            raise
+        cache_requests.inc(result="stale")
+        warnings.warn(f"Using the cached copy of {key} fetched at {time.ctime(entry[1]['fetched_at'])}: {e}")
+        return entry[0]
+
+    if response.status_code == 304 and entry is not None:
+        cache_requests.inc(result="revalidated")
+        content = entry[0]
+    else:
+        cache_requests.inc(result="miss")
+        content = response.content
+    write_entry(name, content, {
+        "key": [str(k) for k in key],
+        "url": url,
+        "fetched_at": time.time(),
+        "etag": response.headers.get("ETag", entry[1].get("etag") if entry else None),
+        "last_modified": response.headers.get("Last-Modified", entry[1].get("last_modified") if entry else None),
+    })
+    return content
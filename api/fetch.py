@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from api.metrics import fetch_failures, fetch_retries
+
+SHEETS_URL = os.environ.get("LEVEKAR_SHEETS_URL", "https://docs.google.com/spreadsheets/d/")
+
+definition_fetch = {
+    "max_workers": 8,  # threads shared by all the hosts
+    "per_host": 4,  # simultaneous requests against the same host
+    "timeout": 20,  # seconds for one attempt of one sheet
+    "retries": 3,  # attempts made after the first one fails
+    "backoff": 0.5,  # seconds to wait before a retry, doubled each time
+    # workbook: one xlsx export per spreadsheet, split locally; sheets: one gviz request per tab
+    "mode": os.environ.get("LEVEKAR_FETCH_MODE", "workbook"),
+}
+
+_session = None
+_session_lock = threading.Lock()
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+
+def sheet_url(key: str, sheet: str, cell_range: str) -> str:
+    """Url of the gviz CSV export of `cell_range` (e.g. A9:G69) in the tab `sheet` of the spreadsheet `key`"""
+    return SHEETS_URL + key + '/gviz/tq?tqx=out:csv&range=' + cell_range + '&sheet=' + sheet
+
+
+def workbook_url(key: str) -> str:
+    """Url of the xlsx export of the whole spreadsheet `key`, every tab in one download"""
+    return SHEETS_URL + key + '/export?format=xlsx'
+
+
+def get_session() -> requests.Session:
+    """Return the HTTP session shared by every download, its connection pool is sized after `max_workers`"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=definition_fetch["max_workers"],
+                                  pool_maxsize=definition_fetch["max_workers"])
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+
+def host_limit(url: str) -> threading.BoundedSemaphore:
+    """Return the semaphore bounding the number of simultaneous requests against the host of `url`"""
+    host = urlsplit(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(definition_fetch["per_host"])
+        return _host_limits[host]
+
+
+def request(url: str, headers: dict = None, timeout: float = None, retries: int = None,
+            backoff: float = None) -> requests.Response:
+    """Send a GET request to `url` and return the response
+
+    Server errors (5xx, 429) and network errors are retried `retries` times with an exponential backoff,
+    other HTTP errors are raised immediately.
+
+    Parameters
+        ----------
+        url : str
+            The url to download
+        headers : dict, optional
+            Headers of the request (e.g. If-None-Match)
+        timeout : float, optional
+            Timeout in seconds of one attempt, `definition_fetch["timeout"]` by default
+        retries : int, optional
+            Number of retries, `definition_fetch["retries"]` by default
+        backoff : float, optional
+            First waiting time in seconds between two attempts, `definition_fetch["backoff"]` by default
+
+    Return
+        ---------
+        The response, its status is lower than 400
+    """
+    timeout = definition_fetch["timeout"] if timeout is None else timeout
+    retries = definition_fetch["retries"] if retries is None else retries
+    backoff = definition_fetch["backoff"] if backoff is None else backoff
+    attempt = 0
+    while True:
+        try:
+            with host_limit(url):
+                response = get_session().get(url, headers=headers, timeout=timeout)
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                return response
+            error = requests.HTTPError(f"{response.status_code} for url: {url}", response=response)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        if attempt >= retries:
+            fetch_failures.inc(host=urlsplit(url).netloc)
+            raise error
+        fetch_retries.inc(host=urlsplit(url).netloc)
+        time.sleep(backoff * 2 ** attempt)
+        attempt += 1
+
+
+def download(url: str, **kwargs) -> bytes:
+    """Download `url` and return the body, the keyword arguments are the ones of `request`"""
+    return request(url, **kwargs).content
@@ -1,24 +1,48 @@
+import hashlib
+import io
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 
+from api.cache import cached_download
+from api.fetch import definition_fetch, sheet_url, workbook_url
+from api.metrics import sheet_fetch_seconds
+
+try:
+    import openpyxl
+except ImportError:  # openpyxl is optional, the tabs are then downloaded one by one
+    openpyxl = None
+
+MAPS_URL = os.environ.get("LEVEKAR_MAPS_URL", "https://kart.trondheim.kommune.no/levekar2020/")
+
 definition_ages = [
-    "https://kart.trondheim.kommune.no/levekar2020/personer0_17/2018.js",  # 8.5
-    "https://kart.trondheim.kommune.no/levekar2020/personer18_34/2018.js",  # 26
-    "https://kart.trondheim.kommune.no/levekar2020/personer35_66/2018.js",  # 50.5
-    "https://kart.trondheim.kommune.no/levekar2020/personer67/2018.js",  # 83.5
+    MAPS_URL + "personer0_17/2018.js",  # 8.5
+    MAPS_URL + "personer18_34/2018.js",  # 26
+    MAPS_URL + "personer35_66/2018.js",  # 50.5
+    MAPS_URL + "personer67/2018.js",  # 83.5
 ]
 
 # Instead use this we should maybe use "columnName" property of sheets
 definition_finalNames = ["Andel", "Antall", "Gjennomsnittspris"]  # , 'Konfidensintervall']
 
-definition_properties = {
-    "Levekårsone-nummer": [],
-    "Levekårsnavn": [],
-    "Ages": [],
-    "Price": [],
-    "Nærmiljø": [],
-    "geometry": []
-}
+# Columns of the GeoJSON properties, in order. Read-only: shared by every thread, see `new_properties` for a
+# dictionary to fill with `add_properties`
+definition_properties = MappingProxyType({
+    "Levekårsone-nummer": (),
+    "Levekårsnavn": (),
+    "Ages": (),
+    "Price": (),
+    "Nærmiljø": (),
+    "geometry": ()
+})
+
+ID_COLUMN = "Levekårsone-nummer"
+NAME_COLUMN = "Levekårsnavn"
 
 # Values for distribution : quantity | proportion | average | median | quintiles
 
@@ -82,41 +106,246 @@ definition_sheets = {
     },
 }
 
-function_converters = {
-    'Andel': lambda s: percent_to_float(s),
-    'Gjennomsnittspris': lambda s: string_to_int(s)
+definition_parsers = {
+    "proportion": "percent",  # "12,5 %" -> 0.13
+    "average": "integer",  # "2\xa0400\xa0000" -> 2400000
+    "quantity": "integer",
+}
+
+
+def sheet_schema(sheets: dict) -> dict:
+    """Return the parser of each column of the sheets, from the `columnName` and `distribution` of `sheets`"""
+    schema = {ID_COLUMN: "integer", "Antall": "integer"}
+    for subject in sheets.values():
+        schema[subject["columnName"]] = definition_parsers[subject["distribution"]]
+    return schema
+
+
+definition_schema = sheet_schema(definition_sheets)
+
+
+def _cells(column: pd.Series) -> tuple[pd.Series, pd.Series, pd.Series]:
+    """Split `column` in the cells read as numbers (from a workbook export) and the cells read as text
+
+    Return
+        ---------
+        A tuple (numeric, numbers, text): which cells are numbers, their value, and the other cells as text
+    """
+    if pd.api.types.infer_dtype(column, skipna=True) in ("string", "empty"):  # a CSV export, no cell to check
+        return pd.Series(False, index=column.index), pd.Series(np.nan, index=column.index), column.astype("string")
+    numeric = column.map(lambda v: isinstance(v, (int, float, np.number)) and not isinstance(v, bool)).astype(bool)
+    numbers = pd.to_numeric(column.where(numeric), errors="coerce").astype(float)
+    return numeric, numbers, column.where(~numeric).astype("string")
+
+
+def parse_percent(column: pd.Series) -> pd.Series:
+    """Parse a column of percentages ("12,5 %", or 0.125 read as a number) to fractions rounded to 2 decimals"""
+    numeric, numbers, text = _cells(column)
+    text = text.str.replace("\xa0", "", regex=False).str.strip().str.rstrip("%").str.strip()
+    text = text.str.replace(",", ".", regex=False)
+    fractions = pd.to_numeric(text, errors="coerce").astype(float) / 100
+    return pd.Series(np.where(numeric, numbers, fractions), index=column.index).round(2).astype("Float64")
+
+
+def parse_integer(column: pd.Series) -> pd.Series:
+    """Parse a column of integers, possibly with (non-breaking) spaces as thousands separator or read as numbers"""
+    numeric, numbers, text = _cells(column)
+    parsed = pd.to_numeric(text.str.replace(r"[\s\xa0]", "", regex=True), errors="coerce").astype(float)
+    values = pd.Series(np.where(numeric, numbers, parsed), index=column.index)
+    return values.where(values % 1 == 0).astype("Int64")
+
+
+function_parsers = {
+    "percent": parse_percent,
+    "integer": parse_integer,
 }
 
 
-def percent_to_float(s: str) -> float:
-    if s == "":
-        return 0.0
-    s = s.strip("%")
-    s = s.replace(',', '.')
-    return round(float(s) / 100, 2)
+def parse_dataframe(dataframe: pd.DataFrame, schema: dict) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Parse the columns of `dataframe` (read as text) listed in `schema`, one column at once
+
+    Parameters
+        ----------
+        dataframe : pandas.DataFrame
+            Data read as text (or as numbers from a workbook export), the empty cells are empty strings
+        schema : dict
+            The parser of each column, {columnName: "percent" | "integer"}
 
+    Return
+        ---------
+        A tuple (parsed, failures): the DataFrame with nullable typed columns (empty cells become <NA>), and a
+        DataFrame with the index, the column and the value of each cell that could not be parsed
+    """
+    parsed = dataframe.copy()
+    failures = []
+    for columnName, parser in schema.items():
+        if columnName not in dataframe:
+            continue
+        text = dataframe[columnName].astype("string")
+        values = function_parsers[parser](dataframe[columnName])
+        failed = values.isna() & text.fillna("").str.strip().ne("")
+        if failed.any():
+            failures.append(pd.DataFrame({"column": columnName, "value": text[failed]}))
+        parsed[columnName] = values
+    if failures:
+        failures = pd.concat(failures)
+    else:
+        failures = pd.DataFrame({"column": pd.Series(dtype=str), "value": pd.Series(dtype=str)},
+                                index=dataframe.index[:0])
+    return parsed, failures
+
+
+def parse_sheets(dataframes: dict, schema: dict = None) -> tuple[dict, list]:
+    """Parse all the sheets of `dataframes` (see `fetch_sheets`) at once
 
-def string_to_int(s: str) -> None | int:
-    res = s.replace("\xa0", '')
-    if not res.isdigit():
-        return None
-    return int(res)
+    Return
+        ---------
+        A tuple (dataframes, failures): the parsed sheets, and a list of the cells that could not be parsed,
+        e.g. {"subject": "Price", "sub_subject": "small", "column": "Gjennomsnittspris", "row": 3, "value": "-"}
+    """
+    if schema is None:
+        schema = definition_schema
+    if not dataframes:
+        return {}, []
+    keys = list(dataframes.keys())
+    combined = pd.concat(dataframes.values(), keys=range(len(keys)), names=["sheet", "row"])
+    parsed, failed = parse_dataframe(combined, schema)
+    failures = [{"subject": keys[sheet][0], "sub_subject": keys[sheet][1], "column": column, "row": row,
+                 "value": value}
+                for (sheet, row), column, value in zip(failed.index, failed["column"], failed["value"])]
+    if failures:
+        warnings.warn(f"{len(failures)} values could not be parsed, e.g. {failures[0]}")
+    return {key: parsed.xs(i, level="sheet")[list(dataframes[key].columns)] for i, key in enumerate(keys)}, failures
 
 
 def data_from_sheet(key: str, sheet: str, start_column: chr, start_line: int, end_column: chr, end_line: int,
-                    names: list = None, converters: dict = None) -> pd.DataFrame:
-    df = pd.read_csv('https://docs.google.com/spreadsheets/d/' +
-                     key +
-                     '/gviz/tq?tqx=out:csv&range=' + start_column + str(start_line) + ':' + end_column + str(end_line) +
-                     '&sheet=' +
-                     sheet,
+                    names: list = None, converters: dict = None, raw: bool = False) -> pd.DataFrame:
+    """Read a range of a sheet, with `raw` every cell is kept as text (empty cells are empty strings)"""
+    cell_range = start_column + str(start_line) + ':' + end_column + str(end_line)
+    content = cached_download(sheet_url(key, sheet, cell_range), key, sheet, cell_range)
+    df = pd.read_csv(io.BytesIO(content),
                      names=names,
-                     converters=converters
+                     converters=converters,
+                     dtype=str if raw else None,
+                     keep_default_na=not raw
                      )
     df.columns = df.columns.str.replace('\n', '')
     return df
 
 
+def sheet_range(workbook, sheet: str, start_column: chr, start_line: int, end_column: chr,
+                end_line: int) -> pd.DataFrame:
+    """Read a range of a tab of an openpyxl workbook like `data_from_sheet` with `raw`: the first line is the
+    header, the empty cells are empty strings and the numbers are kept as numbers"""
+    rows = workbook[sheet].iter_rows(min_row=start_line, max_row=end_line, min_col=ord(start_column) - ord('A') + 1,
+                                     max_col=ord(end_column) - ord('A') + 1, values_only=True)
+    rows = [["" if value is None else value if isinstance(value, (int, float, str)) else str(value)
+             for value in row] for row in rows]
+    if not rows:
+        return pd.DataFrame()
+    df = pd.DataFrame(rows[1:], columns=[str(name) for name in rows[0]], dtype=object)
+    df.columns = df.columns.str.replace('\n', '')
+    return df
+
+
+def fetch_workbooks(sheets: dict, max_workers: int = None) -> dict:
+    """Download each spreadsheet of `sheets` once as a workbook and split its tabs (see `fetch_sheets`)"""
+    keys = list(dict.fromkeys(sheets[subject]["key"] for subject in sheets))
+    if max_workers is None:
+        max_workers = definition_fetch["max_workers"]
+
+    def fetch(key):
+        with sheet_fetch_seconds.time(sheet=key):
+            content = cached_download(workbook_url(key), key, "xlsx")
+            workbook = openpyxl.load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+            try:
+                return {(subject, subSubject): sheet_range(workbook, page, 'A', 9, 'G', 69)
+                        for subject in sheets if sheets[subject]["key"] == key
+                        for subSubject, page in sheets[subject]["values"].items()}
+            finally:
+                workbook.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(keys)))) as executor:
+        tabs = {}
+        for workbook in executor.map(fetch, keys):
+            tabs.update(workbook)
+    return {(subject, subSubject): tabs[(subject, subSubject)]
+            for subject in sheets for subSubject in sheets[subject]["values"]}
+
+
+def fetch_sheets(sheets: dict, max_workers: int = None) -> dict:
+    """Download every sheet of `sheets` concurrently, as text (see `parse_sheets`)
+
+    The downloads run in a bounded thread pool, `api.fetch.download` limits the requests per host and retries the
+    failed ones. The result keeps the order of `sheets`, so the data is merged in the same order as before.
+    In the "workbook" mode of `definition_fetch` (with openpyxl installed) each spreadsheet is downloaded once
+    (see `fetch_workbooks`), otherwise each tab is.
+
+    Parameters
+        ----------
+        sheets : dict
+            Definition of the sheets, like `definition_sheets`
+        max_workers : int, optional
+            Size of the thread pool, `definition_fetch["max_workers"]` by default
+
+    Return
+        ---------
+        A Dictionary {(subject, subSubject): DataFrame} in the order of `sheets`
+    """
+    if definition_fetch["mode"] == "workbook" and openpyxl is not None:
+        return fetch_workbooks(sheets, max_workers)
+    pages = [(subject, subSubject, sheets[subject]["key"], page)
+             for subject in sheets.keys()
+             for subSubject, page in sheets[subject]["values"].items()]
+    if max_workers is None:
+        max_workers = definition_fetch["max_workers"]
+
+    def fetch(page):
+        with sheet_fetch_seconds.time(sheet=page[0] + "/" + page[1]):
+            return data_from_sheet(page[2], page[3], 'A', 9, 'G', 69, raw=True)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pages)))) as executor:
+        dataframes = executor.map(fetch, pages)
+        return {(subject, subSubject): dataframe
+                for (subject, subSubject, _, _), dataframe in zip(pages, dataframes)}
+
+
+def zones_from_url(url: str) -> gpd.GeoDataFrame:
+    """Read the zones and their geometry from `url` (e.g. definition_ages[0]) through the on-disk cache"""
+    return gpd.read_file(io.BytesIO(cached_download(url, url)))
+
+
+def fingerprint(dataframe: pd.DataFrame) -> str:
+    """Hash of the content of a sheet read as text (see `fetch_sheets`), changes when any cell or header changes"""
+    digest = hashlib.sha256("\x1f".join(map(str, dataframe.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(dataframe, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def compare_tables(old: pd.DataFrame, new: pd.DataFrame) -> dict:
+    """Compare two wide tables (see `build_table`) zone by zone, two missing values are equal
+
+    Return
+        ---------
+        A Dictionary with the ids of the "added", "removed" and "changed" zones of `new`
+    """
+    common = new.index.intersection(old.index, sort=False)
+    columns = new.columns.union(old.columns, sort=False)
+    before = old.reindex(index=common, columns=columns)
+    after = new.reindex(index=common, columns=columns)
+    equal = (before == after).fillna(False) | (before.isna() & after.isna())
+    return {
+        "added": python_values(new.index.difference(old.index, sort=False).to_series()),
+        "removed": python_values(old.index.difference(new.index, sort=False).to_series()),
+        "changed": python_values(common[~equal.all(axis=1).to_numpy()].to_series()),
+    }
+
+
+def new_properties(properties=definition_properties) -> dict:
+    """Return a new dictionary with an empty list for each column of `properties`, to fill with `add_properties`"""
+    return {column: [] for column in properties}
+
+
 def add_properties(properties: dict, dataframe: pd.DataFrame, subject: str, sub_subject: str,
                    final_names=None) -> dict:
     """Add data from DataFrame to the argument `properties`, e.g.: properties.subject.subSubject
@@ -163,7 +392,8 @@ def add_properties(properties: dict, dataframe: pd.DataFrame, subject: str, sub_
     Parameters
         ----------
         properties : dict
-            Dictionary used for generate the GeoDataFrame, it contains all data and the `geometry` column
+            Dictionary used for generate the GeoDataFrame, it contains all data and the `geometry` column. It is
+            filled in place, so it must be a new one (see `new_properties`), never `definition_properties`
         dataframe : pandas.DataFrame
             Data to add to the `properties` dictionary
         subject : str
@@ -197,8 +427,131 @@ def add_properties(properties: dict, dataframe: pd.DataFrame, subject: str, sub_
     return properties
 
 
+def build_table(dataframes: dict, final_names: list = None) -> pd.DataFrame:
+    """Build the wide table of the data: one column per (subject, sub_subject, measure), one row per zone
+
+    A `dataframes` dictionary like this (as returned by `fetch_sheets`):
+    dataframes = {
+        ("A_Subject", "A_Subsubject"): DataFrame(Levekårsone-nummer, Levekårsnavn, average, useless_data),
+        ("A_Subject", "B_Subsubject"): DataFrame(Levekårsone-nummer, Levekårsnavn, average, useless_data),
+    }
+
+    Call the function like this: build_table(dataframes, ["average"])
+
+    Result:
+    Levekårsone-nummer | (A_Subject, A_Subsubject, average), (A_Subject, B_Subsubject, average)|
+    ---------------------------------------------------------------------------------------------|
+                  id_0 |                         average_0,                         average_0'|
+                  id_1 |                         average_1,                         average_1'|
+
+    The rows are aligned on `Levekårsone-nummer` and keep the order of the first sheet.
+
+    Parameters
+        ----------
+        dataframes : dict
+            The sheets, {(subject, sub_subject): DataFrame}
+        final_names : list, optional
+            The measures to keep, all the columns except the id and the name by default
+
+    Return
+        ---------
+        A DataFrame indexed by `Levekårsone-nummer` with a (subject, sub_subject, measure) MultiIndex as columns
+    """
+    columns = {}
+    for (subject, sub_subject), dataframe in dataframes.items():
+        dataframe = dataframe.dropna(subset=[ID_COLUMN]).set_index(ID_COLUMN)
+        for columnName in dataframe:
+            if columnName != NAME_COLUMN and (not final_names or columnName in final_names):
+                columns[(subject, sub_subject, columnName)] = dataframe[columnName]
+    if not columns:
+        return pd.DataFrame(index=pd.Index([], name=ID_COLUMN),
+                            columns=pd.MultiIndex.from_tuples([], names=["subject", "sub_subject", "measure"]))
+    ids = None
+    for column in columns.values():
+        ids = column.index if ids is None else ids.append(column.index[~column.index.isin(ids)])
+    table = pd.concat(columns, axis=1, sort=False).reindex(ids)
+    table.index.name = ID_COLUMN
+    table.columns.names = ["subject", "sub_subject", "measure"]
+    return table
+
+
+def zone_names(dataframes: dict) -> pd.Series:
+    """Return the name of each zone of the sheets, indexed by `Levekårsone-nummer`"""
+    names = pd.concat([dataframe.dropna(subset=[ID_COLUMN]).set_index(ID_COLUMN)[NAME_COLUMN]
+                       for dataframe in dataframes.values()])
+    return names[~names.index.duplicated()]
+
+
+def python_values(column: pd.Series) -> list:
+    """Return the values of `column` as Python objects, with None for the missing values (NaN, <NA>)"""
+    return [None if pd.isna(value) else value.item() if isinstance(value, np.generic) else value
+            for value in column.tolist()]
+
+
+def nested_properties(table: pd.DataFrame, subjects: list = None) -> dict:
+    """Convert the columns of `table` (see `build_table`) to the nested shape of the GeoJSON properties
+
+    Result:
+    {
+        "A_Subject": [
+            {"A_Subsubject": {"average": average_0}, "B_Subsubject": {"average": average_0'}},
+            {"A_Subsubject": {"average": average_1}, "B_Subsubject": {"average": average_1'}}
+        ]
+    }
+
+    Parameters
+        ----------
+        table : pandas.DataFrame
+            The wide table
+        subjects : list, optional
+            The subjects to convert, all the subjects of `table` by default
+
+    Return
+        ---------
+        A Dictionary {subject: list of one dictionary per row of `table`}
+    """
+    if subjects is None:
+        subjects = list(pd.unique(table.columns.get_level_values(0)))
+    properties = {}
+    for subject in subjects:
+        rows = [{} for _ in range(len(table))]
+        if subject in table.columns.get_level_values(0):
+            for (sub_subject, columnName), column in table[subject].items():
+                for row, value in zip(rows, python_values(column)):
+                    row.setdefault(sub_subject, {})[columnName] = value
+        properties[subject] = rows
+    return properties
+
+
+def match_geometry(ids: list, geodataframe: gpd.GeoDataFrame, id_geo: str = "levekårsone") -> tuple[list, list, list]:
+    """Find the geometry of each id of `ids` with a hash index on the `id_geo` column of `geodataframe`
+
+    Parameters
+        ----------
+        ids : list
+            The ids to look for, e.g. the names of the zones
+        geodataframe : geopandas.GeoDataFrame
+            GeoDataFrame with the `id_geo` and `geometry` columns
+        id_geo : str, optional
+            The id column used in the GeoDataFrame object
+    Return
+        ---------
+        A tuple (geometries, unmatched, duplicated): the geometry of each id in the order of `ids` (None when not
+        found), the ids without geometry and the ids found several times in `geodataframe` (the first one is used)
+    """
+    index = pd.Index(geodataframe[id_geo])
+    repeated = index.duplicated()
+    wanted = set(ids)
+    duplicated = [i for i in pd.unique(index[repeated]) if i in wanted]
+    unique_index = index[~repeated]
+    geometries = geodataframe["geometry"].to_numpy()[~repeated]
+    positions = unique_index.get_indexer(ids)
+    unmatched = [ids[i] for i in (positions == -1).nonzero()[0]]
+    return [geometries[p] if p != -1 else None for p in positions], unmatched, duplicated
+
+
 def add_geometry_column(properties: dict, geodataframe: gpd.GeoDataFrame, id_property: str = "Levekårsnavn",
-                        id_geo: str = "levekårsone") -> dict:
+                        id_geo: str = "levekårsone", strict: bool = False) -> dict:
     """Add data to `geometry` column
 
     Fill the `geometry` column of the `properties` dictionary with the geometry data of `geodataframe`.
@@ -236,22 +589,77 @@ def add_geometry_column(properties: dict, geodataframe: gpd.GeoDataFrame, id_pro
             The id column used in the `properties` dictionary
         id_geo : str, optional
             The id column used in the GeoDataFrame object
+        strict : bool, optional
+            Raise a ValueError instead of a warning when an id has no geometry or several ones
     Return
         ---------
-        A Dictionary fill with geometry data
+        A Dictionary fill with geometry data, aligned with `id_property` (None for the ids without geometry)
     """
-    for name in properties[id_property]:
-        for j in range(len(geodataframe[id_geo])):
-            if name == geodataframe[id_geo][j]:
-                properties["geometry"].append(geodataframe["geometry"][j])
+    geometries, unmatched, duplicated = match_geometry(list(properties[id_property]), geodataframe, id_geo)
+    _report_join(id_property, id_geo, unmatched, duplicated, strict)
+    properties["geometry"] = geometries
     return properties
 
 
+def _report_join(id_property: str, id_geo: str, unmatched: list, duplicated: list, strict: bool):
+    if unmatched or duplicated:
+        message = f"Geometry join on {id_property} = {id_geo}: unmatched {unmatched}, duplicated {duplicated}"
+        if strict:
+            raise ValueError(message)
+        warnings.warn(message)
+
+
+def create_zones(names: pd.Series, geodataframe: gpd.GeoDataFrame, id_geo: str = "levekårsone",
+                 strict: bool = False) -> gpd.GeoDataFrame:
+    """Return the zones of `names` with their geometry, indexed by `Levekårsone-nummer`
+
+    Parameters
+        ----------
+        names : pandas.Series
+            The name of each zone, as returned by `zone_names`
+        geodataframe : geopandas.GeoDataFrame
+            GeoDataFrame with all data for the `geometry` column
+        id_geo : str, optional
+            The column of `geodataframe` containing the name of the zone
+        strict : bool, optional
+            Raise a ValueError instead of a warning when a zone has no geometry or several ones
+    Return
+        ---------
+        A GeoDataFrame with the `Levekårsnavn` and `geometry` columns
+    """
+    geometries, unmatched, duplicated = match_geometry(names.to_list(), geodataframe, id_geo)
+    _report_join(NAME_COLUMN, id_geo, unmatched, duplicated, strict)
+    return gpd.GeoDataFrame({NAME_COLUMN: names.to_list(), "geometry": geometries}, index=names.index,
+                            crs="urn:ogc:def:crs:OGC:1.3:CRS84")
+
+
+def to_geodataframe(properties: dict, zones: gpd.GeoDataFrame, table: pd.DataFrame) -> gpd.GeoDataFrame:
+    """Build the GeoDataFrame sent to the clients, with the columns of `properties` and the nested subjects
+
+    Parameters
+        ----------
+        properties : dict
+            Dictionary giving the columns of the result (e.g. `definition_properties`), it is not modified
+        zones : geopandas.GeoDataFrame
+            The zones, as returned by `create_zones`
+        table : pandas.DataFrame
+            The wide table, as returned by `build_table`
+    Return
+        ---------
+        A GeoDataFrame with one row per zone
+    """
+    zones = zones.reindex(table.index)
+    subjects = [column for column in properties.keys() if column not in (ID_COLUMN, NAME_COLUMN, "geometry")]
+    columns = {ID_COLUMN: table.index.to_list(), NAME_COLUMN: zones[NAME_COLUMN].to_list()}
+    columns.update(nested_properties(table, subjects))
+    columns["geometry"] = zones.geometry.to_list()
+    return gpd.GeoDataFrame({column: columns[column] for column in properties.keys()},
+                            crs="urn:ogc:def:crs:OGC:1.3:CRS84")
+
+
 def create_geojson_file(properties: dict, sheets: dict, geodataframe: gpd.GeoDataFrame, final_names: list[str],
-                        converters: dict) -> gpd.GeoDataFrame:
-    for subject in sheets.keys():
-        for subSubject, page in sheets[subject]["values"].items():
-            dataframe = data_from_sheet(sheets[subject]["key"], page, 'A', 9, 'G', 69, converters=converters)
-            properties = add_properties(properties, dataframe, subject, subSubject, final_names)
-    properties = add_geometry_column(properties, geodataframe)
-    return gpd.GeoDataFrame(properties, crs="urn:ogc:def:crs:OGC:1.3:CRS84")
\ No newline at end of file
+                        schema: dict = None) -> gpd.GeoDataFrame:
+    dataframes, _ = parse_sheets(fetch_sheets(sheets), schema)
+    table = build_table(dataframes, final_names)
+    zones = create_zones(zone_names(dataframes), geodataframe)
+    return to_geodataframe(properties, zones, table)
@@ -0,0 +1,20 @@
+"""Loader of the multi-process mode: build the snapshot, publish it in the snapshot store and refresh it
+
+    python -m api.loader
+    LEVEKAR_ROLE=worker gunicorn -w 4 "main:create_app(preload_dataset=True)"
+
+The workers never build the dataset, they memory-map the version in `CURRENT` of the store and attach to each new
+version published by the loader (see `attach_snapshot`).
+"""
+from api.snapshot import current_snapshot, definition_serving, start_refresher
+
+
+def main():
+    definition_serving["role"] = "standalone"
+    snapshot = current_snapshot()
+    print(f"Published the snapshot {snapshot.version}")
+    start_refresher().join()
+
+
+if __name__ == "__main__":
+    main()
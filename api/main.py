@@ -2,6 +2,7 @@
 
 from flask import Flask
 from flask_restful import reqparse, abort, Api, Resource
+from shapely.geometry import Point
 
 app = Flask(__name__)
 api = Api(app)
@@ -0,0 +1,116 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+definition_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Counter:
+    """Prometheus counter, `inc(stage="parse")` with the label names given at the creation"""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name, self.documentation, self.labels = name, documentation, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"] + \
+            [f"{self.name}{_labels(self.labels, key)} {value}" for key, value in values.items()]
+
+
+class Gauge:
+    """Prometheus gauge, its value is set with `set` or read from `function` at each scrape"""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), function=None):
+        self.name, self.documentation, self.labels, self.function = name, documentation, tuple(labels), function
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[tuple(labels[n] for n in self.labels)] = value
+
+    def render(self) -> list[str]:
+        if self.function is not None:
+            value = self.function()
+            values = {} if value is None else {(): value}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"] + \
+            [f"{self.name}{_labels(self.labels, key)} {value}" for key, value in values.items()]
+
+
+class Histogram:
+    """Prometheus histogram, `observe(0.2, stage="parse")` or `with histogram.time(stage="parse"):`"""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = definition_buckets):
+        self.name, self.documentation, self.labels, self.buckets = name, documentation, tuple(labels), buckets
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][i] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), key + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """All the metrics in the Prometheus text format"""
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+stage_seconds = Histogram("levekar_stage_seconds", "Duration of each stage of the build of a snapshot", ("stage",))
+sheet_fetch_seconds = Histogram("levekar_sheet_fetch_seconds", "Duration of the fetch of each sheet", ("sheet",))
+cache_requests = Counter("levekar_cache_requests_total", "Lookups in the on-disk cache of the sources", ("result",))
+fetch_retries = Counter("levekar_fetch_retries_total", "Retried downloads", ("host",))
+fetch_failures = Counter("levekar_fetch_failures_total", "Downloads failed after all the retries", ("host",))
+refresh_failures = Counter("levekar_refresh_failures_total", "Failed refreshes of the snapshot")
+request_seconds = Histogram("levekar_request_seconds", "Duration of the HTTP requests", ("endpoint", "method",
+                                                                                       "status"))
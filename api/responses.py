@@ -0,0 +1,75 @@
+import hashlib
+import zlib
+from typing import Iterable
+
+from flask import Response, request, stream_with_context
+
+try:
+    import brotli
+except ImportError:  # listed in requirements.txt, gzip alone is served without it
+    brotli = None
+
+CACHE_CONTROL = "public, max-age=60"
+CHUNK_SIZE = 256 * 1024
+
+
+def encode_payload(chunks: Iterable[bytes]) -> dict:
+    """Compute once the ETag and the compressed versions of a body, given whole or in chunks
+
+    Return
+        ---------
+        A Dictionary {"etag": str, "identity": bytes, "gzip": bytes, "br": bytes (if Brotli is installed)}
+    """
+    if isinstance(chunks, bytes):
+        chunks = [chunks]
+    digest = hashlib.sha256()
+    gzip_compressor = zlib.compressobj(9, zlib.DEFLATED, 31)  # 31: gzip header and trailer
+    brotli_compressor = brotli.Compressor(quality=11) if brotli is not None else None
+    identity, gzip_parts, brotli_parts = [], [], []
+    for chunk in chunks:
+        digest.update(chunk)
+        identity.append(chunk)
+        gzip_parts.append(gzip_compressor.compress(chunk))
+        if brotli_compressor is not None:
+            brotli_parts.append(brotli_compressor.process(chunk))
+    payload = {
+        "etag": '"' + digest.hexdigest()[:32] + '"',
+        "identity": b"".join(identity),
+        "gzip": b"".join(gzip_parts) + gzip_compressor.flush(),
+    }
+    if brotli_compressor is not None:
+        payload["br"] = b"".join(brotli_parts) + brotli_compressor.finish()
+    return payload
+
+
+def payload_response(payload: dict, mimetype: str = 'application/json') -> Response:
+    """Answer the current request with `payload` (see `encode_payload`)
+
+    A request with a matching If-None-Match gets a 304 without body, otherwise the best encoding accepted by the
+    client is sent (Brotli, gzip, then none).
+    """
+    headers = {"ETag": payload["etag"], "Cache-Control": CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    if_none_match = request.headers.get("If-None-Match", "")
+    if if_none_match.strip() == "*" or payload["etag"] in [tag.strip().removeprefix("W/")
+                                                            for tag in if_none_match.split(",")]:
+        return Response(status=304, headers=headers)
+    for encoding in ("br", "gzip"):
+        if encoding in payload and request.accept_encodings[encoding]:
+            headers["Content-Encoding"] = encoding
+            return _body_response(payload[encoding], mimetype, headers)
+    return _body_response(payload["identity"], mimetype, headers)
+
+
+def _body_response(body, mimetype: str, headers: dict) -> Response:
+    """A body given as bytes is sent as is, a memory-mapped one (see `load_snapshot`) in chunks"""
+    if isinstance(body, bytes):
+        return Response(body, mimetype=mimetype, headers=headers)
+    view = memoryview(body)
+    headers["Content-Length"] = str(len(view))
+    return Response((bytes(view[i:i + CHUNK_SIZE]) for i in range(0, len(view), CHUNK_SIZE)), mimetype=mimetype,
+                    headers=headers, direct_passthrough=True)
+
+
+def stream_response(chunks: Iterable[bytes], mimetype: str = 'application/json') -> Response:
+    """Answer the current request with the body produced chunk by chunk by `chunks`"""
+    return Response(stream_with_context(chunks), mimetype=mimetype)
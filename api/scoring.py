@@ -0,0 +1,403 @@
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from api.function import definition_sheets, python_values
+from api.metrics import Counter
+from api.spatial import position_of
+
+DEFAULT_WEIGHT = 4
+
+# Inputs of the user (see PARAMETERS in api/main.py) scored with the Nærmiljø data,
+# direction -1 when a low value is better
+definition_features = {
+    "well_being_input": {"values": ["trivsel-kvinner", "trivsel-menn"], "direction": 1},
+    "safety_input": {"values": ["trygghet-kvinner", "trygghet-menn"], "direction": 1},
+    "culture_input": {"values": ["tilgjengelighet kultur-kvinner", "tilgjengelighet kultur-menn"], "direction": 1},
+    "outdoor_input": {"values": ["tilgjengelighet friluftsområder-kvinner", "tilgjengelighet friluftsområder-menn"],
+                      "direction": 1},
+    "transport_input": {"values": ["tilgjengelighet offentlig transport-kvinner",
+                                   "tilgjengelighet offentlig transport-menn"], "direction": 1},
+    "walkway_input": {"values": ["tilgjengelighet gang og sykkelvei-kvinner",
+                                 "tilgjengelighet gang og sykkelvei-menn"], "direction": 1},
+    "noise_traffic_input": {"values": ["plaget av trafikk støy-kvinner", "plaget av trafikk støy-menn"],
+                            "direction": -1},
+    "noise_other_input": {"values": ["plaget av annen støy-kvinner", "plaget av annen støy-menn"], "direction": -1},
+    "grocery_input": {"values": ["tilgjengelighet butikker-kvinner", "tilgjengelighet butiker-menn"],
+                      "direction": 1},
+}
+
+# Inputs with a selection of sub subjects, each selected sub subject is a feature
+definition_selections = {
+    "age_input": {"subject": "Ages", "direction": 1},  # a high share of the selected ages is better
+    "price_input": {"subject": "Price", "direction": -1},  # a low price is better
+}
+
+# Cache of the rankings, the parameters are rounded to these steps so that close requests share an entry
+definition_ranking_cache = {
+    "max_entries": 4096,
+    "ttl": 15 * 60,  # seconds
+    "weight_step": 0.5,
+    "budget_step": 50000,  # NOK
+    "percent_step": 0.01,
+    "position_decimals": 4,  # about 10 m
+}
+
+_rankings = OrderedDict()  # (version, parameters key, top_k) -> (expires, ranking)
+_rankings_lock = threading.Lock()
+_rankings_version = {"version": None}
+ranking_cache_requests = Counter("levekar_ranking_cache_requests_total", "Lookups in the cache of the rankings",
+                                 ("result",))
+
+
+def check_parameters(parameters) -> None:
+    """Raise ValueError, with a message for the client, if `parameters` is not shaped like PARAMETERS: an object
+    whose inputs are objects with numeric `weight` (0 or more), `percent` and `budget`, lists of names as
+    `selected` and a valid `distance_input.posistion`"""
+    if not isinstance(parameters, dict):
+        raise ValueError("Expected an object shaped like PARAMETERS")
+    for name in (*definition_features, *definition_selections, "distance_input"):
+        parameter = parameters.get(name)
+        if parameter is None:
+            continue
+        if not isinstance(parameter, dict):
+            raise ValueError(f"{name} must be an object")
+        for field in ("weight", "percent", "budget"):
+            value = parameter.get(field)
+            if value is None or value == "":
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                raise ValueError(f"{name}.{field} must be a number")
+            if field == "weight" and value < 0:
+                raise ValueError(f"{name}.weight must be 0 or more")
+        selected = parameter.get("selected")
+        if selected is not None and not (isinstance(selected, list) and all(isinstance(s, str) for s in selected)):
+            raise ValueError(f"{name}.selected must be a list of names")
+    try:
+        position_of(parameters)
+    except (TypeError, ValueError, IndexError, KeyError):
+        raise ValueError("distance_input.posistion must be [lon, lat] or a GeoJSON Point") from None
+
+
+def _weight(parameter: dict) -> float:
+    """The `weight` of a selection or of the distance, DEFAULT_WEIGHT when it is missing or null"""
+    weight = parameter.get("weight")
+    return DEFAULT_WEIGHT if weight is None or weight == "" else weight
+
+
+def _measure(table: pd.DataFrame, subject: str, sub_subjects: list) -> np.ndarray:
+    """Mean over `sub_subjects` of the `columnName` measure of `subject`, NaN when missing"""
+    columnName = definition_sheets[subject]["columnName"]
+    columns = [table[(subject, sub_subject, columnName)].astype("Float64").to_numpy(dtype=float, na_value=np.nan)
+               for sub_subject in sub_subjects if (subject, sub_subject, columnName) in table.columns]
+    if not columns:
+        return np.full(len(table), np.nan)
+    with np.errstate(all="ignore"):
+        return np.nanmean(np.column_stack(columns), axis=1)
+
+
+def _normalize(values: np.ndarray, direction: int) -> np.ndarray:
+    """Scale `values` to [0, 1], 1 being the best zone, the missing values get 0"""
+    known = np.isfinite(values)
+    if not known.any():
+        return np.zeros(len(values))
+    low, high = values[known].min(), values[known].max()
+    if high > low:
+        scaled = (values - low) / (high - low)
+        if direction < 0:
+            scaled = 1 - scaled
+    else:
+        scaled = np.ones(len(values))
+    return np.where(known, scaled, 0.0)
+
+
+def build_model(table: pd.DataFrame, names: pd.Series) -> dict:
+    """Precompute the normalized zone×feature matrix used by `rank`
+
+    Parameters
+        ----------
+        table : pandas.DataFrame
+            The wide table of a snapshot (see `build_table`)
+        names : pandas.Series
+            The name of each zone, indexed like `table`
+
+    Return
+        ---------
+        A Dictionary with the feature names, the matrix (zones × features, values in [0, 1]), the raw values
+        used by the constraints of `rank` and the ids and names of the zones
+    """
+    features, columns, raw = [], [], {}
+    for feature, definition in definition_features.items():
+        features.append(feature)
+        columns.append(_normalize(_measure(table, "Nærmiljø", definition["values"]), definition["direction"]))
+    for selection, definition in definition_selections.items():
+        subject = definition["subject"]
+        for sub_subject in definition_sheets[subject]["values"]:
+            values = _measure(table, subject, [sub_subject])
+            features.append(f"{selection}/{sub_subject}")
+            columns.append(_normalize(values, definition["direction"]))
+            raw[f"{selection}/{sub_subject}"] = values
+    matrix = np.ascontiguousarray(np.column_stack(columns) if columns else np.zeros((len(table), 0)))
+    for array in [matrix, *raw.values()]:
+        array.flags.writeable = False  # the model is shared by the request threads
+    return {
+        "features": features,
+        "positions": {feature: i for i, feature in enumerate(features)},
+        "matrix": matrix,
+        "raw": raw,
+        "ids": python_values(table.index.to_series()),
+        "names": python_values(names.reindex(table.index)),
+    }
+
+
+def profile_weights(model: dict, parameters: dict) -> np.ndarray:
+    """Return the weight of each feature of `model` for a `parameters` dictionary shaped like PARAMETERS
+
+    The weights of the inputs of `definition_features` are their `weight`. The weight of `age_input` and
+    `price_input` (their `weight`, DEFAULT_WEIGHT by default) is shared by their selected sub subjects.
+    """
+    weights = np.zeros(len(model["features"]))
+    positions = model["positions"]
+    for feature in definition_features:
+        if feature in parameters:
+            weights[positions[feature]] = float(parameters[feature].get("weight", 0) or 0)
+    for selection in definition_selections:
+        selected = [s for s in (parameters.get(selection) or {}).get("selected") or []
+                    if f"{selection}/{s}" in positions]
+        for sub_subject in selected:
+            weight = float(_weight(parameters[selection]))
+            weights[positions[f"{selection}/{sub_subject}"]] = weight / len(selected)
+    return weights
+
+
+def eligible_zones(model: dict, parameters: dict) -> np.ndarray:
+    """Return which zones satisfy the constraints of `parameters`
+
+    The mean price of the selected sizes must be under `price_input.budget`, and the share of the people of the
+    selected ages must be at least `age_input.percent`. A zone without data for a constraint satisfies it.
+    """
+    eligible = np.ones(len(model["ids"]), dtype=bool)
+    constraints = {"price_input": ("budget", np.less_equal, np.nanmean),
+                   "age_input": ("percent", np.greater_equal, np.nansum)}
+    for selection, (limit, compare, combine) in constraints.items():
+        parameter = parameters.get(selection) or {}
+        columns = [model["raw"][f"{selection}/{s}"] for s in parameter.get("selected") or []
+                   if f"{selection}/{s}" in model["raw"]]
+        if parameter.get(limit) is None or not columns:
+            continue
+        values = np.column_stack(columns)
+        with np.errstate(all="ignore"):
+            combined = combine(values, axis=1)
+        combined[np.isnan(values).all(axis=1)] = np.nan
+        eligible &= np.isnan(combined) | compare(combined, float(parameter[limit]))
+    return eligible
+
+
+def rank(model: dict, parameters: dict, top_k: int = None, distances: np.ndarray = None) -> list[dict]:
+    """Rank the zones for the preferences `parameters` (see `rank_batch`)
+
+    The score of a zone is the weighted mean of its normalized features, between 0 and 1. The zones satisfying
+    the constraints of `parameters` (see `eligible_zones`) come first.
+
+    Parameters
+        ----------
+        model : dict
+            The model of a snapshot (see `build_model`)
+        parameters : dict
+            The preferences, shaped like PARAMETERS in api/main.py
+        top_k : int, optional
+            Number of zones to return, all of them by default
+        distances : numpy.ndarray, optional
+            Distance of each zone to `distance_input.posistion` (see `zone_distances`), the nearest zones get the
+            weight of `distance_input` (DEFAULT_WEIGHT by default)
+
+    Return
+        ---------
+        A list of {"Levekårsone-nummer", "Levekårsnavn", "score", "eligible", "contributions"}, best zone first
+    """
+    return rank_batch(model, [parameters], top_k, [distances])[0]
+
+
+def top_zones(scores: np.ndarray, eligible: np.ndarray, top_k: int = None) -> np.ndarray:
+    """Indices of the `top_k` best zones of each column of `scores`, the eligible zones first
+
+    Parameters
+        ----------
+        scores : numpy.ndarray
+            The zones × profiles scores
+        eligible : numpy.ndarray
+            The zones × profiles constraints (see `eligible_zones`)
+        top_k : int, optional
+            Number of zones to return, all of them by default
+
+    Return
+        ---------
+        A top_k × profiles array, best zone first (ties in the order of the zones)
+    """
+    zones = scores.shape[0]
+    if top_k is not None and top_k <= 0:
+        return np.zeros((0, scores.shape[1]), dtype=int)
+    threshold = None
+    if top_k is not None and top_k < zones:
+        # the ineligible zones are moved below every eligible one before the partial selection, the zones tied with
+        # the top_k-th key are all kept so that the ties are broken by the order of the zones below
+        span = scores.max(axis=0) - scores.min(axis=0) + 1
+        key = np.where(eligible, scores, scores - span)
+        threshold = -np.partition(-key, top_k - 1, axis=0)[top_k - 1]
+    columns = []
+    for profile in range(scores.shape[1]):
+        selected = np.arange(zones) if threshold is None else np.flatnonzero(key[:, profile] >= threshold[profile])
+        order = selected[np.lexsort((selected, -scores[selected, profile], ~eligible[selected, profile]))]
+        columns.append(order[:top_k])
+    return np.column_stack(columns) if columns else np.zeros((0, 0), dtype=int)
+
+
+def rank_batch(model: dict, profiles: list, top_k: int = None, distances: list = None) -> list[list[dict]]:
+    """Rank the zones for many preferences at once with one zones×features by features×profiles product
+
+    Parameters
+        ----------
+        model : dict
+            The model of a snapshot (see `build_model`)
+        profiles : list
+            The preferences, each shaped like PARAMETERS in api/main.py
+        top_k : int, optional
+            Number of zones to return for each profile, all of them by default
+        distances : list, optional
+            For each profile, the distance of each zone to its `distance_input.posistion` or None (see `rank`)
+
+    Return
+        ---------
+        For each profile, the list returned by `rank`
+    """
+    if not profiles:
+        return []
+    matrix, features = model["matrix"], model["features"]
+    if distances is None:
+        distances = [None] * len(profiles)
+    weights = np.column_stack([profile_weights(model, parameters) for parameters in profiles])
+    distance_weights = np.array([float(_weight(parameters["distance_input"]))
+                                 if distance is not None else 0.0
+                                 for parameters, distance in zip(profiles, distances)])
+    proximity = np.column_stack([_normalize(distance, -1) if distance is not None else np.zeros(len(matrix))
+                                 for distance in distances])
+    totals = weights.sum(axis=0) + distance_weights
+    scale = np.divide(1.0, totals, out=np.ones(len(totals)), where=totals > 0)
+    weights, distance_weights = weights * scale, distance_weights * scale
+    scores = matrix @ weights + proximity * distance_weights
+    eligible = np.column_stack([eligible_zones(model, parameters) for parameters in profiles])
+    orders = top_zones(scores, eligible, top_k)
+
+    results = []
+    for profile, parameters in enumerate(profiles):
+        order = orders[:, profile]
+        used = weights[:, profile].nonzero()[0]
+        contributions = matrix[np.ix_(order, used)] * weights[used, profile]
+        names = [features[i] for i in used]
+        if distance_weights[profile]:
+            contributions = np.column_stack([contributions, proximity[order, profile] * distance_weights[profile]])
+            names.append("distance_input")
+        results.append([{
+            "Levekårsone-nummer": model["ids"][i],
+            "Levekårsnavn": model["names"][i],
+            "score": round(float(scores[i, profile]), 4),
+            "eligible": bool(eligible[i, profile]),
+            "contributions": dict(zip(names, np.round(contributions[row], 4).tolist())),
+        } for row, i in enumerate(order)])
+    return results
+
+
+def _quantize(value, step: float) -> float | None:
+    if value is None or value == "":
+        return None
+    return round(round(float(value) / step) * step, 6)
+
+
+def canonical_parameters(parameters: dict) -> dict:
+    """Return the part of `parameters` used by `rank`, with sorted selections and rounded numbers
+
+    Two requests with the same canonical parameters get the same ranking, see `definition_ranking_cache` for the
+    rounding. The result is shaped like PARAMETERS and can be given to `rank`.
+    """
+    steps = definition_ranking_cache
+    canonical = {}
+    for feature in definition_features:
+        weight = _quantize((parameters.get(feature) or {}).get("weight") or 0, steps["weight_step"])
+        if weight:
+            canonical[feature] = {"weight": weight}
+    for selection, limit, step in (("age_input", "percent", steps["percent_step"]),
+                                   ("price_input", "budget", steps["budget_step"])):
+        parameter = parameters.get(selection) or {}
+        selected = sorted(set(parameter.get("selected") or []))
+        if selected:
+            canonical[selection] = {
+                "selected": selected,
+                "weight": _quantize(_weight(parameter), steps["weight_step"]),
+                limit: _quantize(parameter.get(limit), step),
+            }
+    position = position_of(parameters)
+    if position is not None:
+        canonical["distance_input"] = {
+            "posistion": [round(c, steps["position_decimals"]) for c in position],
+            "weight": _quantize(_weight(parameters["distance_input"]), steps["weight_step"]),
+        }
+    return canonical
+
+
+def cached_rankings(version: int, model, profiles: list, top_k: int = None, distances=None) -> list[list[dict]]:
+    """`rank_batch` through an LRU cache keyed by the canonical parameters, emptied when `version` changes
+
+    Parameters
+        ----------
+        version : int
+            The version of the snapshot of `model`
+        model : callable
+            Return the model of the snapshot (see `build_model`), only called on a miss
+        profiles : list
+            The preferences, each shaped like PARAMETERS in api/main.py
+        top_k : int, optional
+            Number of zones to return for each profile, all of them by default
+        distances : callable, optional
+            Return the distance of each zone to a (longitude, latitude) (see `zone_distances`)
+
+    Return
+        ---------
+        For each profile, the list returned by `rank` for its canonical parameters
+    """
+    canonical = [canonical_parameters(parameters) for parameters in profiles]
+    keys = [(version, json.dumps(parameters, sort_keys=True), top_k) for parameters in canonical]
+    now = time.monotonic()
+    results = {}
+    with _rankings_lock:
+        if _rankings_version["version"] != version:
+            _rankings.clear()
+            _rankings_version["version"] = version
+        for key in keys:
+            entry = _rankings.get(key)
+            if entry is not None and entry[0] > now:
+                _rankings.move_to_end(key)
+                results[key] = entry[1]
+    ranked = {key: parameters for key, parameters in zip(keys, canonical) if key not in results}
+    for key in keys:
+        ranking_cache_requests.inc(result="miss" if key in ranked else "hit")
+
+    if ranked:
+        positions = {key: position_of(parameters) for key, parameters in ranked.items()}
+        computed = {position: distances(*position) for position in set(positions.values()) if position}
+        rankings = rank_batch(model(), list(ranked.values()), top_k,
+                              [computed[position] if position else None for position in positions.values()])
+        expires = now + definition_ranking_cache["ttl"]
+        with _rankings_lock:
+            for key, ranking in zip(ranked, rankings):
+                results[key] = ranking
+                if key[0] == _rankings_version["version"]:
+                    _rankings[key] = (expires, ranking)
+                    _rankings.move_to_end(key)
+            while len(_rankings) > definition_ranking_cache["max_entries"]:
+                _rankings.popitem(last=False)
+    return [results[key] for key in keys]
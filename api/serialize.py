@@ -0,0 +1,74 @@
+import json
+from typing import Iterable, Iterator
+
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+from api.function import ID_COLUMN, NAME_COLUMN, nested_properties, python_values
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the json module is used instead
+    orjson = None
+
+CHUNK_SIZE = 64 * 1024
+
+
+def dumps(obj) -> bytes:
+    """Serialize `obj` to compact JSON, the missing values must already be None"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def iter_features(zones: gpd.GeoDataFrame, table: pd.DataFrame, columns: Iterable[str]) -> Iterator[bytes]:
+    """Serialize each zone of `table` to a GeoJSON Feature, one zone at a time
+
+    Parameters
+        ----------
+        zones : geopandas.GeoDataFrame
+            Name and geometry of the zones (see `create_zones`)
+        table : pandas.DataFrame
+            The wide table (see `build_table`)
+        columns : Iterable[str]
+            The properties of a feature in order, e.g. the keys of `definition_properties`. `Levekårsone-nummer`,
+            `Levekårsnavn` and `geometry` are taken from the zones, the other ones are subjects of `table`. Without
+            `geometry` the geometries are null
+
+    Return
+        ---------
+        An iterator over the features, as JSON
+    """
+    zones = zones.reindex(table.index)
+    columns = list(columns)
+    with_geometry = "geometry" in columns
+    columns = [column for column in columns if column != "geometry"]
+    subjects = [column for column in columns if column not in (ID_COLUMN, NAME_COLUMN)]
+    values = {ID_COLUMN: python_values(table.index.to_series()), NAME_COLUMN: python_values(zones[NAME_COLUMN])}
+    values.update(nested_properties(table, subjects))
+    geometries = shapely.to_geojson(zones.geometry.to_numpy()) if with_geometry else [None] * len(table)
+    for i in range(len(table)):
+        properties = dumps({column: values[column][i] for column in columns})
+        geometry = geometries[i].encode("utf-8") if geometries[i] is not None else b"null"
+        # the id is the Levekårsone-nummer, the same in the full documents, the deltas and their `removed`
+        yield b'{"id":%b,"type":"Feature","properties":%b,"geometry":%b}' % (dumps(values[ID_COLUMN][i]), properties,
+                                                                             geometry)
+
+
+def iter_geojson(zones: gpd.GeoDataFrame, table: pd.DataFrame, columns: Iterable[str],
+                 chunk_size: int = CHUNK_SIZE, members: dict = None) -> Iterator[bytes]:
+    """Serialize the zones to a GeoJSON FeatureCollection in chunks of about `chunk_size` bytes (see
+    `iter_features`), the whole document is never held in memory. `members` are added to the FeatureCollection"""
+    chunk = [b'{"type":"FeatureCollection","features":[']
+    size = len(chunk[0])
+    for i, feature in enumerate(iter_features(zones, table, columns)):
+        if i:
+            chunk.append(b",")
+        chunk.append(feature)
+        size += len(feature) + 1
+        if size >= chunk_size:
+            yield b"".join(chunk)
+            chunk, size = [], 0
+    chunk.append(b"]" + b"".join(b",%b:%b" % (dumps(k), dumps(v)) for k, v in (members or {}).items()) + b"}")
+    yield b"".join(chunk)
@@ -0,0 +1,407 @@
+import hashlib
+import io
+import mmap
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from types import MappingProxyType
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+import shapely
+
+from api.cache import cached_download
+from api.function import ID_COLUMN, NAME_COLUMN, build_table, compare_tables, create_zones, definition_ages, \
+    definition_finalNames, definition_properties, definition_sheets, fetch_sheets, fingerprint, parse_sheets, \
+    python_values, zone_names
+from api.metrics import Gauge, refresh_failures, stage_seconds
+from api.responses import encode_payload
+from api.serialize import iter_geojson
+from api.store import current_version, read_version, versions, write_version
+from api.tiles import prepare_tiles, simplified_zones
+from api.timeseries import definition_timeseries, record_year
+
+REFRESH_INTERVAL = int(os.environ.get("LEVEKAR_REFRESH_SECONDS", 60 * 60))
+
+definition_serving = {
+    # standalone: the process builds and refreshes the snapshot (`python -m api.loader` does only that)
+    # worker: the process never builds, it attaches to the version published in the snapshot store by the loader
+    "role": os.environ.get("LEVEKAR_ROLE", "standalone"),
+    "poll_seconds": float(os.environ.get("LEVEKAR_POLL_SECONDS", 2)),  # check of `CURRENT` by a worker
+    # the requests are answered 503 without building for this time after a failed first build
+    "retry_seconds": float(os.environ.get("LEVEKAR_RETRY_SECONDS", 30)),
+}
+
+
+class SnapshotUnavailable(LookupError):
+    """Raised when there is no snapshot to serve yet: a worker before the loader published one in the store, or a
+    standalone process whose first build failed"""
+
+
+def freeze(value):
+    """Read-only copy of `value`: the dictionaries become MappingProxyType, the lists tuples and the numpy arrays
+    are not writeable"""
+    if isinstance(value, (dict, MappingProxyType)):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, np.ndarray):
+        value = value.view()
+        value.flags.writeable = False
+    return value
+
+
+def thaw(value):
+    """Copy of a value frozen by `freeze` made of dictionaries and lists, e.g. to serialize it to JSON"""
+    if isinstance(value, (dict, MappingProxyType)):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """A built dataset, never modified after its creation
+
+    A snapshot is shared by every request thread without lock: it is published by replacing the reference to the
+    current one (see `publish`). `parse_failures`, `fingerprints` and `changelog` are frozen (see `freeze`), the
+    DataFrames are new ones built for the snapshot and must not be modified, the data derived from it is computed
+    once under a lock of its own (see `derived`).
+
+    version : int
+        Build time in milliseconds, increase with each build
+    built_at : float
+        Build time (time.time())
+    zones : geopandas.GeoDataFrame
+        Name and geometry of the zones, indexed by `Levekårsone-nummer`
+    table : pandas.DataFrame
+        The data, one column per (subject, sub_subject, measure) and one row per zone (see `build_table`)
+    body : bytes
+        The GeoJSON document sent to the clients, memory-mapped when the snapshot is loaded from the store
+    parse_failures : tuple
+        The cells of the sheets that could not be parsed (see `parse_sheets`)
+    fingerprints : dict
+        Hash of the content of each source, {(subject, sub_subject) or ("geometry", url): hash}
+    changelog : dict
+        What changed since the previous snapshot (see `build_snapshot`)
+    derived : dict
+        Data computed from the snapshot on first use, see `derived`
+    derived_locks : dict
+        The lock of the build of each entry of `derived`
+    """
+    version: int
+    built_at: float
+    zones: gpd.GeoDataFrame
+    table: pd.DataFrame
+    body: bytes
+    parse_failures: tuple = ()
+    fingerprints: dict = field(default_factory=dict)
+    changelog: dict = None
+    derived: dict = field(default_factory=dict, repr=False, compare=False)
+    derived_locks: dict = field(default_factory=dict, repr=False, compare=False)
+
+    def __post_init__(self):
+        for name in ("parse_failures", "fingerprints", "changelog"):
+            object.__setattr__(self, name, freeze(getattr(self, name)))
+
+
+_current = None
+_build_lock = threading.Lock()
+_failed_build = {"at": None}  # time.monotonic() of the last failed build, None after a successful one
+_derived_lock = threading.Lock()  # guards the creation of the locks of `Snapshot.derived_locks`
+
+Gauge("levekar_snapshot_age_seconds", "Time since the build of the published snapshot",
+      function=lambda: time.time() - _current.built_at if _current is not None else None)
+Gauge("levekar_snapshot_version", "Version of the published snapshot",
+      function=lambda: _current.version if _current is not None else None)
+
+
+def build_snapshot(previous: Snapshot = None) -> Snapshot:
+    """Download the data and the geometries and build a new snapshot, without publishing it
+
+    Each sheet is fingerprinted. With a `previous` snapshot only the sheets whose fingerprint changed are parsed
+    and their columns replaced in the table of `previous`; `previous` itself is returned when nothing changed.
+    The `changelog` of the new snapshot lists the changed sheets and the added, removed and changed zones.
+    """
+    with stage_seconds.time(stage="fetch_sheets"):
+        raw = fetch_sheets(definition_sheets)
+    geometry_key = ("geometry", definition_ages[0])
+    with stage_seconds.time(stage="geometry_download"):
+        geometry_content = cached_download(definition_ages[0], definition_ages[0])
+    with stage_seconds.time(stage="fingerprint"):
+        fingerprints = {key: fingerprint(dataframe) for key, dataframe in raw.items()}
+        fingerprints[geometry_key] = hashlib.sha256(geometry_content).hexdigest()
+
+    old = previous.fingerprints if previous is not None else {}
+    changed = [key for key in raw if old.get(key) != fingerprints[key]]
+    removed = [key for key in old if key not in fingerprints]
+    geometry_changed = old.get(geometry_key) != fingerprints[geometry_key]
+    if previous is not None and not changed and not removed and not geometry_changed:
+        return previous
+
+    with stage_seconds.time(stage="parse"):
+        dataframes, failures = parse_sheets({key: raw[key] for key in changed})
+    with stage_seconds.time(stage="table"):
+        table = build_table(dataframes, definition_finalNames)
+        names = zone_names(dataframes) if dataframes else pd.Series(dtype=object)
+        if previous is not None:
+            replaced = set(changed) | set(removed)
+            kept = previous.table[[c for c in previous.table.columns if (c[0], c[1]) not in replaced]]
+            table = pd.concat([kept, table], axis=1, sort=False)
+            table = table[[c for key in raw for c in table.columns if (c[0], c[1]) == key]]
+            table.index.name = ID_COLUMN
+            table.columns.names = ["subject", "sub_subject", "measure"]
+            previous_names = previous.zones[NAME_COLUMN]
+            names = pd.concat([names, previous_names[~previous_names.index.isin(names.index)]])
+            failures = [f for f in previous.parse_failures
+                        if (f["subject"], f["sub_subject"]) not in replaced] + failures
+        names = names.reindex(table.index)
+
+    with stage_seconds.time(stage="geometry_join"):
+        if previous is None or geometry_changed or \
+                not names.equals(previous.zones[NAME_COLUMN].reindex(table.index)):
+            zones = create_zones(names, gpd.read_file(io.BytesIO(geometry_content)))
+        else:
+            zones = previous.zones
+
+    built_at = time.time()
+    version = int(built_at * 1000)
+    changelog = {
+        "version": version,
+        "previous": previous.version if previous is not None else None,
+        "sheets": ["/".join(key) for key in changed],
+        "removed_sheets": ["/".join(key) for key in removed],
+        "geometry": geometry_changed,
+    }
+    if previous is not None:
+        with stage_seconds.time(stage="changelog"):
+            changelog.update(compare_tables(previous.table, table))
+            if geometry_changed:
+                changelog["geometry_changed"] = changed_geometries(previous.zones, zones)
+    with stage_seconds.time(stage="serialize"):
+        full = encode_payload(geojson_chunks(zones, table))
+    return Snapshot(version=version, built_at=built_at, zones=zones, table=table, body=full["identity"],
+                    parse_failures=tuple(failures), fingerprints=fingerprints, changelog=changelog,
+                    derived={"payload:full": full})
+
+
+def changed_geometries(old: gpd.GeoDataFrame, new: gpd.GeoDataFrame) -> list:
+    """Ids of the zones of both `old` and `new` whose geometry is different"""
+    common = new.index.intersection(old.index, sort=False)
+    before = shapely.to_wkb(old.geometry.reindex(common).to_numpy())
+    after = shapely.to_wkb(new.geometry.reindex(common).to_numpy())
+    return python_values(common[before != after].to_series())
+
+
+def geojson_chunks(zones: gpd.GeoDataFrame, table: pd.DataFrame):
+    """Serialize the zones to the GeoJSON document sent to the clients, in chunks"""
+    return iter_geojson(zones, table, definition_properties.keys())
+
+
+def publish(snapshot: Snapshot, store: bool = True):
+    """Make `snapshot` the current one, the requests already running keep the snapshot they have
+
+    With `store` the snapshot is first written in the snapshot store, so the next start loads it instead of
+    building it.
+    """
+    global _current
+    if store:
+        full = payload(snapshot)
+        files = {"body.json": full["identity"], "body.json.gz": full["gzip"]}
+        if "br" in full:
+            files["body.json.br"] = full["br"]
+        write_version(snapshot.version, snapshot.zones, snapshot.table, files, {
+            "version": snapshot.version,
+            "built_at": snapshot.built_at,
+            "etag": full["etag"],
+            "parse_failures": thaw(snapshot.parse_failures),
+            "fingerprints": [list(key) + [value] for key, value in snapshot.fingerprints.items()],
+            "changelog": thaw(snapshot.changelog),
+        })
+        record_year(definition_timeseries["year"], snapshot.table)
+    _current = snapshot
+
+
+def load_snapshot(version: int = None) -> Snapshot | None:
+    """Load a snapshot from the snapshot store, the current version by default, None if the store is empty"""
+    if version is None:
+        version = current_version()
+        if version is None:
+            return None
+    zones, table, files, meta = read_version(version)
+    full = {"etag": meta["etag"]}
+    for encoding, name in (("identity", "body.json"), ("gzip", "body.json.gz"), ("br", "body.json.br")):
+        if name in files:
+            # the pages of the bodies are shared by all the processes mapping the version
+            with open(files[name], "rb") as f:
+                full[encoding] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return Snapshot(version=meta["version"], built_at=meta["built_at"], zones=zones, table=table,
+                    body=full["identity"], parse_failures=tuple(meta["parse_failures"]),
+                    fingerprints={tuple(item[:-1]): item[-1] for item in meta.get("fingerprints", [])},
+                    changelog=meta.get("changelog"), derived={"payload:full": full})
+
+
+def attach_snapshot() -> Snapshot | None:
+    """Publish the version in `CURRENT` of the snapshot store if it is not the published snapshot yet, return the
+    published snapshot (None if the store is empty)"""
+    version = current_version()
+    current = _current
+    if version is None or current is not None and current.version == version:
+        return current
+    with _build_lock:
+        if _current is None or _current.version != version:
+            publish(load_snapshot(version), store=False)
+        return _current
+
+
+def refresh_snapshot(backoff: bool = False) -> Snapshot:
+    """Build and publish a new snapshot from the sheets that changed (see `build_snapshot`), a refresh already
+    running is waited for instead of starting a new one. A worker attaches to the store instead
+
+    With `backoff`, raise SnapshotUnavailable instead of building again within `retry_seconds` of a failed build.
+    """
+    if definition_serving["role"] == "worker":
+        snapshot = attach_snapshot()
+        if snapshot is None:
+            raise SnapshotUnavailable("No snapshot was published in the store yet")
+        return snapshot
+    current = _current
+    with _build_lock:
+        if _current is not current:
+            return _current
+        failed = _failed_build["at"]
+        if backoff and failed is not None and time.monotonic() - failed < definition_serving["retry_seconds"]:
+            raise SnapshotUnavailable("The dataset could not be built, retry later")
+        try:
+            with stage_seconds.time(stage="build"):
+                snapshot = build_snapshot(current)
+        except Exception:
+            _failed_build["at"] = time.monotonic()
+            raise
+        _failed_build["at"] = None
+        if snapshot is not current:
+            publish(snapshot)
+        return snapshot
+
+
+def loaded_snapshot() -> Snapshot | None:
+    """Return the published snapshot, None if none is loaded yet"""
+    return _current
+
+
+def current_snapshot() -> Snapshot:
+    """Return the published snapshot, load it from the snapshot store or build it if there is none yet
+
+    A failed build raises SnapshotUnavailable, and the next builds wait `retry_seconds` (see `refresh_snapshot`).
+    """
+    snapshot = _current
+    if snapshot is None and definition_serving["role"] == "worker":
+        return refresh_snapshot()
+    if snapshot is None:
+        with _build_lock:
+            if _current is None:
+                stored = load_snapshot()
+                if stored is not None:
+                    publish(stored, store=False)
+        if _current is not None:
+            return _current
+        try:
+            snapshot = refresh_snapshot(backoff=True)
+        except SnapshotUnavailable:
+            raise
+        except Exception as e:
+            refresh_failures.inc()
+            print(f"Build of the dataset failed: {e!r}")
+            raise SnapshotUnavailable("The dataset could not be built, retry later") from e
+    return snapshot
+
+
+def start_refresher(interval: int = None) -> threading.Thread:
+    """Refresh the snapshot every `interval` seconds in a daemon thread, a failed refresh keeps the current one
+
+    A worker checks the snapshot store every `poll_seconds` instead (see `attach_snapshot`).
+    """
+    worker = definition_serving["role"] == "worker"
+    if interval is None:
+        interval = definition_serving["poll_seconds"] if worker else REFRESH_INTERVAL
+    update = attach_snapshot if worker else refresh_snapshot
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                update()
+            except Exception as e:
+                refresh_failures.inc()
+                print(f"Refresh of the dataset failed: {e!r}")
+
+    thread = threading.Thread(target=run, name="snapshot-refresher", daemon=True)
+    thread.start()
+    return thread
+
+
+def derived(snapshot: Snapshot, name: str, factory):
+    """Return the data `name` computed once per snapshot with `factory(snapshot)` (e.g. the scoring model)
+
+    Each name is built under its own lock: `factory` may use other derived data (a payload uses the simplified
+    zones), and a slow build does not hold back the requests for the others.
+    """
+    value = snapshot.derived.get(name)
+    if value is None:
+        with _derived_lock:
+            lock = snapshot.derived_locks.setdefault(name, threading.Lock())
+        with lock:
+            value = snapshot.derived.get(name)
+            if value is None:
+                value = factory(snapshot)
+                snapshot.derived[name] = value
+    return value
+
+
+def payload(snapshot: Snapshot, detail: str = "full") -> dict:
+    """The GeoJSON document of `snapshot` with the geometries of the level of detail `detail` (see
+    `definition_details`), with its ETag and compressed versions (see `encode_payload`), built once per snapshot"""
+    return derived(snapshot, "payload:" + detail, lambda s: encode_payload(
+        geojson_chunks(detail_zones(s, detail), s.table)))
+
+
+def changes(snapshot: Snapshot, since: int) -> dict | None:
+    """The zones that changed between the version `since` of the snapshot store and `snapshot`, encoded once per
+    snapshot and version (see `encode_payload`), None if `since` is not in the store anymore
+
+    The document is a FeatureCollection of the added and changed zones, with all their properties. The geometry of
+    a changed zone is null when it did not change. The ids of the removed zones are in its `removed` member.
+    """
+    if since != snapshot.version and since not in versions():
+        return None
+
+    def build(s: Snapshot) -> dict:
+        # read only on the first request for `since`, the encoded delta is then kept with the snapshot
+        old_zones, old_table = (s.zones, s.table) if since == s.version else read_version(since)[:2]
+        compared = compare_tables(old_table, s.table)
+        added, moved = set(compared["added"]), set(changed_geometries(old_zones, s.zones))
+        common = s.zones.index.intersection(old_zones.index, sort=False)
+        renamed = s.zones[NAME_COLUMN].reindex(common).fillna("").ne(old_zones[NAME_COLUMN].reindex(common).fillna(""))
+        changed = added | moved | set(compared["changed"]) | set(python_values(common[renamed.to_numpy()].to_series()))
+        ids = [i for i in python_values(s.table.index.to_series()) if i in changed]
+        zones = s.zones.reindex(ids)
+        new_geometry = np.array([i in added or i in moved for i in ids], dtype=bool)
+        zones = zones.set_geometry(zones.geometry.where(new_geometry, None))
+        return encode_payload(iter_geojson(zones, s.table.loc[ids], definition_properties.keys(), members={
+            "version": s.version, "since": since, "removed": compared["removed"]}))
+
+    return derived(snapshot, f"changes:{since}", build)
+
+
+def detail_zones(snapshot: Snapshot, detail: str) -> gpd.GeoDataFrame:
+    """The zones of `snapshot` with the geometries of the level of detail `detail`, built once per snapshot"""
+    return derived(snapshot, "zones:" + detail, lambda s: simplified_zones(s.zones, detail))
+
+
+def tiles(snapshot: Snapshot) -> dict:
+    """The zones of `snapshot` prepared for `api.tiles.tile`"""
+    return derived(snapshot, "tiles", lambda s: prepare_tiles(s.zones, s.table))
@@ -0,0 +1,77 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import Transformer
+from shapely.strtree import STRtree
+
+from api.function import NAME_COLUMN, python_values
+
+METRIC_CRS = "EPSG:25832"  # ETRS89 / UTM zone 32N, distances in meters
+
+_to_metric = Transformer.from_crs("EPSG:4326", METRIC_CRS, always_xy=True)
+
+
+def build_index(zones: gpd.GeoDataFrame) -> dict:
+    """Project the zones to UTM 32N and index them in a STRtree, once per snapshot
+
+    Parameters
+        ----------
+        zones : geopandas.GeoDataFrame
+            The zones of a snapshot (see `create_zones`)
+
+    Return
+        ---------
+        A Dictionary with the tree, the projected geometries, the centroids (zones × 2 array, NaN without
+        geometry) and the ids and names of the zones, in the order of `zones`
+    """
+    geometries = zones.geometry.to_crs(METRIC_CRS).to_numpy()
+    centroids = np.full((len(geometries), 2), np.nan)
+    known = ~shapely.is_missing(geometries)
+    if known.any():
+        centroids[known] = shapely.get_coordinates(shapely.centroid(geometries[known]))
+    for array in (geometries, centroids):
+        array.flags.writeable = False  # the index is shared by the request threads
+    return {
+        "tree": STRtree(geometries),
+        "geometries": geometries,
+        "centroids": centroids,
+        "ids": python_values(zones.index.to_series()),
+        "names": python_values(zones[NAME_COLUMN]),
+    }
+
+
+def position_of(parameters: dict) -> tuple[float, float] | None:
+    """Return the (longitude, latitude) of `distance_input.posistion`, given as [lon, lat], a GeoJSON Point or a
+    shapely Point, None if there is none"""
+    position = (parameters.get("distance_input") or {}).get("posistion")
+    if position is None:
+        return None
+    if isinstance(position, dict):
+        position = position.get("coordinates")
+    elif hasattr(position, "x"):
+        position = (position.x, position.y)
+    return float(position[0]), float(position[1])
+
+
+def to_metric(lon: float, lat: float) -> shapely.Point:
+    return shapely.Point(*_to_metric.transform(lon, lat))
+
+
+def zone_containing(index: dict, lon: float, lat: float) -> int | None:
+    """Return the position of the zone containing the point, None if the point is in no zone"""
+    found = index["tree"].query(to_metric(lon, lat), predicate="intersects")
+    return int(found.min()) if len(found) else None
+
+
+def nearest_zone(index: dict, lon: float, lat: float) -> tuple[int, float] | None:
+    """Return the position of the zone nearest to the point and the distance in meters (0 inside the zone)"""
+    found, distances = index["tree"].query_nearest(to_metric(lon, lat), return_distance=True, all_matches=False)
+    if not len(found):
+        return None
+    return int(found[0]), float(distances[0])
+
+
+def zone_distances(index: dict, lon: float, lat: float) -> np.ndarray:
+    """Return the distance in meters from the point to the centroid of each zone (NaN without geometry)"""
+    x, y = _to_metric.transform(lon, lat)
+    return np.hypot(index["centroids"][:, 0] - x, index["centroids"][:, 1] - y)
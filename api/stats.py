@@ -0,0 +1,91 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from api.function import definition_sheets, python_values
+from api.zones import is_selected, parse_fields
+
+QUINTILES = (0.2, 0.4, 0.6, 0.8)
+
+
+def _rounded(values: np.ndarray) -> list:
+    """The values as a list rounded to 4 decimals, None for NaN"""
+    values = np.round(values.astype(float), 4)
+    return np.where(np.isnan(values), None, values).tolist()
+
+
+def build_stats(table: pd.DataFrame) -> dict:
+    """Compute the distribution of every column of `table` (see `build_table`) at once
+
+    Parameters
+        ----------
+        table : pandas.DataFrame
+            The wide table of a snapshot
+
+    Return
+        ---------
+        A Dictionary with the columns, the ids of the zones and one array per statistic: "count", "min", "max",
+        "mean", "median", "std" (one value per column), "quintiles" (the breakpoints, columns × 4), "z_scores"
+        and "quintile_ranks" (zones × columns, from 1 to 5, 0 for a missing value). NaN when a column is empty
+    """
+    values = table.astype("Float64").to_numpy(dtype=float, na_value=np.nan)
+    known = ~np.isnan(values)
+    count = known.sum(axis=0)
+    with np.errstate(all="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # the empty columns give NaN
+        mean = np.nanmean(values, axis=0)
+        std = np.nanstd(values, axis=0)
+        stats = {
+            "min": np.nanmin(values, axis=0),
+            "max": np.nanmax(values, axis=0),
+            "mean": mean,
+            "median": np.nanmedian(values, axis=0),
+            "std": std,
+            "quintiles": np.nanquantile(values, QUINTILES, axis=0).T,
+            "z_scores": np.where(std > 0, (values - mean) / std, 0.0),
+        }
+    stats["z_scores"][~known] = np.nan
+    ranks = 1 + (values[:, :, None] > stats["quintiles"][None, :, :]).sum(axis=2)
+    stats["quintile_ranks"] = np.where(known, ranks, 0)
+    stats["count"] = count
+    for array in stats.values():
+        array.flags.writeable = False  # the statistics are shared by the request threads
+    return dict(stats, columns=[tuple(column) for column in table.columns],
+                ids=python_values(table.index.to_series()))
+
+
+def distribution(column: tuple) -> str | None:
+    """The distribution of the (subject, sub_subject, measure) `column`, as in `sheet_schema`: the one of the subject
+    for its `columnName`, "quantity" for the counts ("Antall"), None for the other measures"""
+    subject = definition_sheets.get(column[0])
+    if subject is not None and column[2] == subject["columnName"]:
+        return subject["distribution"]
+    return "quantity" if column[2] == "Antall" else None
+
+
+def describe(stats: dict, fields: list = None, zones: bool = False) -> dict:
+    """The statistics of the columns selected by `fields` (see `parse_fields`), for the clients
+
+    Return
+        ---------
+        A Dictionary {"subject/sub_subject/measure": {"distribution", "count", "min", "max", "mean", "median",
+        "std", "quintiles"}}, with the z-scores and the quintile ranks of every zone if `zones`
+    """
+    wanted = parse_fields(fields) if fields else None
+    selected = [i for i, column in enumerate(stats["columns"]) if wanted is None or is_selected(column, wanted)]
+    result = {}
+    for i in selected:
+        column = stats["columns"][i]
+        described = {
+            "distribution": distribution(column),
+            "count": int(stats["count"][i]),
+        }
+        for name in ("min", "max", "mean", "median", "std"):
+            described[name] = _rounded(stats[name][i:i + 1])[0]
+        described["quintiles"] = _rounded(stats["quintiles"][i])
+        if zones:
+            described["z_scores"] = _rounded(stats["z_scores"][:, i])
+            described["quintile_ranks"] = [int(rank) or None for rank in stats["quintile_ranks"][:, i]]
+        result["/".join(column)] = described
+    return result
@@ -0,0 +1,141 @@
+import json
+import os
+import shutil
+import tempfile
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import shapely
+
+from api.cache import write_atomic
+from api.function import ID_COLUMN, NAME_COLUMN
+
+definition_store = {
+    "directory": os.environ.get("LEVEKAR_SNAPSHOT_DIR", "snapshots"),
+    "keep": 5,  # number of versions kept in the store
+}
+
+CURRENT = "CURRENT"
+_types = {pa.int64(): pd.Int64Dtype(), pa.float64(): pd.Float64Dtype()}
+
+
+def version_path(version: int) -> str:
+    return os.path.join(definition_store["directory"], str(version))
+
+
+def _write_arrow(path: str, table: pa.Table):
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_arrow(path: str) -> pa.Table:
+    """Read an Arrow IPC file memory-mapped, the buffers are not copied and keep the map open"""
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+def zones_to_arrow(zones: gpd.GeoDataFrame) -> pa.Table:
+    """The zones with the geometry as WKB, the CRS is kept in the metadata"""
+    return pa.table({
+        ID_COLUMN: pa.array(zones.index.to_numpy(dtype=object), pa.int64()),
+        NAME_COLUMN: pa.array(zones[NAME_COLUMN].to_numpy(dtype=object), pa.string()),
+        "geometry": pa.array(shapely.to_wkb(zones.geometry.to_numpy()), pa.binary()),
+    }).replace_schema_metadata({"crs": zones.crs.to_string() if zones.crs else ""})
+
+
+def zones_from_arrow(table: pa.Table) -> gpd.GeoDataFrame:
+    geometries = shapely.from_wkb(table.column("geometry").to_numpy(zero_copy_only=False))
+    crs = table.schema.metadata.get(b"crs", b"").decode() or None
+    index = pd.Index(table.column(ID_COLUMN).to_pandas(types_mapper=_types.get), name=ID_COLUMN)
+    return gpd.GeoDataFrame({NAME_COLUMN: table.column(NAME_COLUMN).to_pylist(), "geometry": geometries},
+                            index=index, crs=crs)
+
+
+def table_to_arrow(table: pd.DataFrame) -> pa.Table:
+    """The wide table with one field per column, the (subject, sub_subject, measure) of each field is kept in the
+    metadata"""
+    arrays = {ID_COLUMN: pa.array(table.index.to_numpy(dtype=object), pa.int64())}
+    for i, column in enumerate(table.columns):
+        arrays[f"c{i}"] = pa.array(table[column], from_pandas=True)
+    return pa.table(arrays).replace_schema_metadata({"columns": json.dumps([list(c) for c in table.columns])})
+
+
+def table_from_arrow(arrow: pa.Table) -> pd.DataFrame:
+    columns = [tuple(c) for c in json.loads(arrow.schema.metadata[b"columns"])]
+    table = arrow.select([f"c{i}" for i in range(len(columns))]).to_pandas(types_mapper=_types.get)
+    table.columns = pd.MultiIndex.from_tuples(columns, names=["subject", "sub_subject", "measure"])
+    table.index = pd.Index(arrow.column(ID_COLUMN).to_pandas(types_mapper=_types.get), name=ID_COLUMN)
+    return table
+
+
+def write_version(version: int, zones: gpd.GeoDataFrame, table: pd.DataFrame, files: dict, meta: dict):
+    """Write a snapshot version in the store, then make it the current one
+
+    The version is written in a temporary directory renamed at the end, and `CURRENT` is replaced atomically,
+    so a reader never sees a partial version. Only the `keep` last versions are kept.
+
+    Parameters
+        ----------
+        version : int
+            The version of the snapshot
+        zones : geopandas.GeoDataFrame
+            The zones (see `create_zones`)
+        table : pandas.DataFrame
+            The wide table (see `build_table`)
+        files : dict
+            Other files of the version, {file name: content}
+        meta : dict
+            Metadata of the version, written as JSON
+    """
+    directory = definition_store["directory"]
+    os.makedirs(directory, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=directory, prefix=".tmp-")
+    try:
+        _write_arrow(os.path.join(tmp, "zones.arrow"), zones_to_arrow(zones))
+        _write_arrow(os.path.join(tmp, "table.arrow"), table_to_arrow(table))
+        for name, content in files.items():
+            with open(os.path.join(tmp, name), "wb") as f:
+                f.write(content)
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, default=str)
+        os.replace(tmp, version_path(version))
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    write_atomic(os.path.join(directory, CURRENT), str(version).encode())
+    for old in versions()[:-definition_store["keep"]]:
+        shutil.rmtree(version_path(old), ignore_errors=True)
+
+
+def versions() -> list[int]:
+    """The versions in the store, oldest first"""
+    directory = definition_store["directory"]
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(name) for name in os.listdir(directory) if name.isdigit())
+
+
+def current_version() -> int | None:
+    """The version in `CURRENT`, None if the store is empty"""
+    try:
+        with open(os.path.join(definition_store["directory"], CURRENT), encoding="utf-8") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def read_version(version: int) -> tuple[gpd.GeoDataFrame, pd.DataFrame, dict, dict]:
+    """Read a snapshot version of the store
+
+    Return
+        ---------
+        A tuple (zones, table, files, meta), `files` gives the path of the other files of the version
+    """
+    path = version_path(version)
+    zones = zones_from_arrow(_read_arrow(os.path.join(path, "zones.arrow")))
+    table = table_from_arrow(_read_arrow(os.path.join(path, "table.arrow")))
+    with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    files = {name: os.path.join(path, name) for name in os.listdir(path)
+             if name not in ("zones.arrow", "table.arrow", "meta.json")}
+    return zones, table, files, meta
@@ -0,0 +1,107 @@
+import math
+import threading
+from collections import OrderedDict
+
+import geopandas as gpd
+import mapbox_vector_tile
+import pandas as pd
+import shapely
+
+from api.function import ID_COLUMN, NAME_COLUMN, python_values
+
+# Simplification tolerance (degrees, 0.00001° is about 1 m in Trondheim) and kept decimals of each level of detail
+definition_details = {
+    "full": {"tolerance": 0, "decimals": None},
+    "high": {"tolerance": 0.00002, "decimals": 6},
+    "medium": {"tolerance": 0.0001, "decimals": 5},
+    "low": {"tolerance": 0.0005, "decimals": 4},
+}
+
+TILE_LAYER = "levekarsoner"
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+MAX_ZOOM = 18
+CACHED_TILES = 4096  # tiles kept per snapshot, the least recently used ones are dropped first
+WEB_MERCATOR_SIZE = 2 * math.pi * 6378137
+
+
+def simplify(geometries: gpd.GeoSeries, tolerance: float, decimals: int = None) -> gpd.GeoSeries:
+    """Simplify the zones together, so the shared borders stay shared, then snap the coordinates to a grid of
+    `decimals` without making the geometries invalid"""
+    values = geometries.to_numpy()
+    if tolerance:
+        values = shapely.coverage_simplify(values, tolerance)
+    if decimals is not None:
+        values = shapely.set_precision(values, 10 ** -decimals)
+    return gpd.GeoSeries(values, index=geometries.index, crs=geometries.crs)
+
+
+def simplified_zones(zones: gpd.GeoDataFrame, detail: str) -> gpd.GeoDataFrame:
+    """Return a copy of `zones` with the geometries of the level of detail `detail` of `definition_details`"""
+    level = definition_details[detail]
+    return zones.set_geometry(simplify(zones.geometry, level["tolerance"], level["decimals"]))
+
+
+def flat_properties(table: pd.DataFrame) -> list[dict]:
+    """Properties of each zone for the tiles: the columns of `table` as "subject/sub_subject/measure", without the
+    missing values"""
+    columns = {"/".join(column): python_values(table[column]) for column in table.columns}
+    rows = [{} for _ in range(len(table))]
+    for name, values in columns.items():
+        for row, value in zip(rows, values):
+            if value is not None:
+                row[name] = value
+    return rows
+
+
+def prepare_tiles(zones: gpd.GeoDataFrame, table: pd.DataFrame) -> dict:
+    """Project the zones of a snapshot to Web Mercator once, for `tile`"""
+    zones = zones.reindex(table.index)
+    properties = flat_properties(table)
+    for row, id_, name in zip(properties, python_values(table.index.to_series()), python_values(zones[NAME_COLUMN])):
+        row[ID_COLUMN] = id_
+        if name is not None:
+            row[NAME_COLUMN] = name
+    mercator = zones.geometry.to_crs("EPSG:3857").reset_index(drop=True)
+    return {"geometries": mercator, "properties": properties, "tiles": OrderedDict(), "lock": threading.Lock()}
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """Bounds in Web Mercator meters of the tile z/x/y (XYZ scheme, y from the top)"""
+    size = WEB_MERCATOR_SIZE / 2 ** z
+    minx = -WEB_MERCATOR_SIZE / 2 + x * size
+    maxy = WEB_MERCATOR_SIZE / 2 - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def tile(prepared: dict, z: int, x: int, y: int) -> bytes:
+    """Encode the Mapbox Vector Tile z/x/y of the zones prepared by `prepare_tiles`
+
+    The geometries are simplified to the size of a pixel of the tile and clipped to the tile plus a buffer. The
+    `CACHED_TILES` most recently used tiles containing zones are kept in `prepared`, so the tiles in use are
+    encoded once per snapshot.
+    """
+    with prepared["lock"]:
+        if (z, x, y) in prepared["tiles"]:
+            prepared["tiles"].move_to_end((z, x, y))
+            return prepared["tiles"][(z, x, y)]
+    bounds = tile_bounds(z, x, y)
+    pixel = (bounds[2] - bounds[0]) / TILE_EXTENT
+    buffer = pixel * TILE_BUFFER
+    geometries = prepared["geometries"]
+    found = geometries.sindex.query(shapely.box(bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer,
+                                                bounds[3] + buffer), predicate="intersects")
+    features = []
+    for i in sorted(found):
+        geometry = shapely.clip_by_rect(geometries.iloc[i].simplify(pixel, preserve_topology=True),
+                                        bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+        if not geometry.is_empty:
+            features.append({"geometry": geometry, "properties": prepared["properties"][i]})
+    content = mapbox_vector_tile.encode([{"name": TILE_LAYER, "features": features}],
+                                        default_options={"quantize_bounds": bounds, "extents": TILE_EXTENT})
+    if features:
+        with prepared["lock"]:
+            prepared["tiles"][(z, x, y)] = content
+            if len(prepared["tiles"]) > CACHED_TILES:
+                prepared["tiles"].popitem(last=False)
+    return content
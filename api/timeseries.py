@@ -0,0 +1,163 @@
+"""Time series of the data of every zone, one year per snapshot
+
+The values are kept in one Arrow IPC file of the snapshot store, in the long format (zone, series, year, value)
+with compact types. Each published snapshot replaces the values of its year (`definition_timeseries["year"]`),
+older years can be imported from a version of the snapshot store:
+
+    LEVEKAR_YEAR=2019 python -m api.timeseries 1589452800000
+"""
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+import pyarrow as pa
+
+from api.cache import write_atomic
+from api.store import definition_store, read_version
+from api.zones import is_selected, parse_fields
+
+definition_timeseries = {
+    "file": "timeseries.arrow",  # in the directory of the snapshot store
+    "year": int(os.environ.get("LEVEKAR_YEAR", 2018)),  # year of the data of the sheets and the maps
+}
+
+_columns = {"zone": pa.int32(), "series": pa.int16(), "year": pa.int16(), "value": pa.float32()}
+_cube = {"stamp": None, "cube": None}
+_cube_lock = threading.Lock()
+
+
+def timeseries_path() -> str:
+    return os.path.join(definition_store["directory"], definition_timeseries["file"])
+
+
+def read_values() -> tuple[list, dict]:
+    """Return the series, as (subject, sub_subject, measure), and the columns of the long table"""
+    path = timeseries_path()
+    if not os.path.exists(path):
+        return [], {name: np.zeros(0, dtype=kind.to_pandas_dtype()) for name, kind in _columns.items()}
+    arrow = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+    series = [tuple(s) for s in json.loads(arrow.schema.metadata[b"series"])]
+    return series, {name: arrow.column(name).to_numpy() for name in _columns}
+
+
+def record_year(year: int, table) -> None:
+    """Replace the values of `year` by the ones of the wide table `table` (see `build_table`)
+
+    Parameters
+        ----------
+        year : int
+            The year of the data
+        table : pandas.DataFrame
+            The wide table of a snapshot, its missing values are not stored
+    """
+    series, columns = read_values()
+    codes = {s: i for i, s in enumerate(series)}
+    for column in table.columns:
+        codes.setdefault(tuple(column), len(codes))
+    values = table.astype("Float64").to_numpy(dtype=float, na_value=np.nan).ravel()
+    new = {
+        "zone": np.repeat(table.index.to_numpy(dtype=np.int64), len(table.columns)),
+        "series": np.tile([codes[tuple(column)] for column in table.columns], len(table)),
+        "year": np.full(len(values), year),
+        "value": values,
+    }
+    kept = columns["year"] != year
+    known = ~np.isnan(values)
+    arrays = {name: pa.array(np.concatenate([columns[name][kept], new[name][known]]).astype(kind.to_pandas_dtype()))
+              for name, kind in _columns.items()}
+    arrow = pa.table(arrays).replace_schema_metadata({"series": json.dumps([list(s) for s in codes])})
+    del columns  # release the map of the file before it is replaced
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, arrow.schema) as writer:
+        writer.write_table(arrow)
+    path = timeseries_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, sink.getvalue())
+
+
+def build_cube(series: list, columns: dict) -> dict:
+    """Arrange the long table (see `read_values`) in a year × zone × series cube, with the change of each value
+    since the previous year of the cube
+
+    Return
+        ---------
+        A Dictionary with the years, the zones, the series, the values and the deltas (float32 arrays, NaN when
+        missing, the deltas of the first year are NaN)
+    """
+    years, year_index = np.unique(columns["year"], return_inverse=True)
+    zones, zone_index = np.unique(columns["zone"], return_inverse=True)
+    values = np.full((len(years), len(zones), len(series)), np.nan, dtype=np.float32)
+    values[year_index, zone_index, columns["series"]] = columns["value"]
+    deltas = np.full_like(values, np.nan)
+    deltas[1:] = values[1:] - values[:-1]
+    for array in (years, zones, values, deltas):
+        array.flags.writeable = False  # the cube is shared by the request threads
+    return {"years": years, "zones": zones, "series": series, "values": values, "deltas": deltas}
+
+
+def current_cube() -> dict | None:
+    """The cube of the time series file, read again when the file changes, None if there is none"""
+    try:
+        stat = os.stat(timeseries_path())
+    except FileNotFoundError:
+        return None
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    if _cube["stamp"] != stamp:
+        with _cube_lock:
+            if _cube["stamp"] != stamp:
+                _cube["cube"] = build_cube(*read_values())
+                _cube["stamp"] = stamp
+    return _cube["cube"]
+
+
+def select(cube: dict, start: int = None, end: int = None, fields: list = None, zones: list = None,
+           deltas: bool = False) -> dict:
+    """Select the years from `start` to `end` (included), the series of `fields` and the `zones` of `cube`
+
+    Parameters
+        ----------
+        cube : dict
+            The cube, see `build_cube`
+        start, end : int, optional
+            The first and the last year, all the years by default
+        fields : list, optional
+            Subjects and sub subjects (see `parse_fields`), all the series by default
+        zones : list, optional
+            The ids of the zones, all the zones by default
+        deltas : bool
+            Return the changes since the previous year instead of the values
+
+    Return
+        ---------
+        A Dictionary {"years", "zones", "series": {"subject/sub_subject/measure": one list of values by year for
+        each zone}}, None for the missing values
+    """
+    years = cube["years"]
+    year_mask = np.ones(len(years), dtype=bool)
+    if start is not None:
+        year_mask &= years >= start
+    if end is not None:
+        year_mask &= years <= end
+    zone_positions = np.arange(len(cube["zones"]))
+    if zones is not None:
+        zone_positions = np.flatnonzero(np.isin(cube["zones"], zones))
+    wanted = parse_fields(fields) if fields else None
+    series = np.array([i for i, s in enumerate(cube["series"]) if wanted is None or is_selected(s, wanted)],
+                      dtype=int)
+    data = (cube["deltas"] if deltas else cube["values"])[np.ix_(np.flatnonzero(year_mask), zone_positions, series)]
+    data = np.round(data.astype(float), 4)
+    return {
+        "years": years[year_mask].tolist(),
+        "zones": cube["zones"][zone_positions].tolist(),
+        "series": {"/".join(cube["series"][s]): np.where(np.isnan(data[:, :, i]), None, data[:, :, i]).T.tolist()
+                   for i, s in enumerate(series)},
+    }
+
+
+if __name__ == "__main__":
+    version = int(sys.argv[1])
+    record_year(definition_timeseries["year"], read_version(version)[1])
+    print(f"Recorded the version {version} as {definition_timeseries['year']}")
@@ -0,0 +1,127 @@
+import base64
+import json
+
+import numpy as np
+import pandas as pd
+
+from api.function import definition_sheets, python_values
+
+
+def parse_fields(fields: list) -> set:
+    """Return the subjects and the (subject, sub_subject) selected by `fields` (see `select_columns`), raise
+    ValueError for a field that is not in `definition_sheets`"""
+    wanted = set()
+    for field in fields:
+        subject, _, sub_subject = field.partition("/")
+        if subject not in definition_sheets or sub_subject and sub_subject not in definition_sheets[subject]["values"]:
+            raise ValueError(f"Unknown field {field!r}")
+        wanted.add((subject, sub_subject) if sub_subject else subject)
+    return wanted
+
+
+def is_selected(column: tuple, wanted: set) -> bool:
+    """Whether the (subject, sub_subject, measure) `column` is selected by `wanted` (see `parse_fields`)"""
+    return column[0] in wanted or tuple(column[:2]) in wanted
+
+
+def select_columns(table: pd.DataFrame, fields: list = None) -> pd.DataFrame:
+    """Return the columns of `table` (see `build_table`) selected by `fields`
+
+    Parameters
+        ----------
+        table : pandas.DataFrame
+            The wide table of a snapshot
+        fields : list, optional
+            Subjects ("Ages") and sub subjects ("Price/small") of `definition_sheets`, all of them by default
+
+    Return
+        ---------
+        The selected columns, in the order of `table`. Raise ValueError for a field that is not in
+        `definition_sheets`
+    """
+    if not fields:
+        return table
+    wanted = parse_fields(fields)
+    return table[[column for column in table.columns if is_selected(column, wanted)]]
+
+
+def sort_column(table: pd.DataFrame, sort: str) -> tuple:
+    """Return the column of `table` named by `sort`: "subject/sub_subject", with the `columnName` of the subject,
+    or "subject/sub_subject/measure". Raise ValueError if there is no such column"""
+    parts = sort.split("/")
+    if len(parts) == 2 and parts[0] in definition_sheets:
+        parts.append(definition_sheets[parts[0]]["columnName"])
+    column = tuple(parts)
+    if len(column) != 3 or column not in table.columns:
+        raise ValueError(f"Unknown sort column {sort!r}")
+    return column
+
+
+def encode_cursor(value, zone_id, sort: str, descending: bool) -> str:
+    """Opaque cursor of the zone after which the next page starts"""
+    state = json.dumps({"value": value, "id": zone_id, "sort": sort, "descending": descending})
+    return base64.urlsafe_b64encode(state.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str, descending: bool) -> tuple:
+    """Return the (value, id) of `cursor`, raise ValueError if it is invalid or was made for another order"""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        value, zone_id = state["value"], int(state["id"])
+        if value is not None:
+            value = float(value)
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Invalid cursor") from None
+    if state.get("sort") != sort or state.get("descending") != descending:
+        raise ValueError("The cursor was made for another order")
+    return value, zone_id
+
+
+def page(table: pd.DataFrame, sort: str = None, descending: bool = True, limit: int = None,
+         cursor: str = None) -> tuple[pd.Index, str | None]:
+    """Select the zones of a page, ordered by the column `sort` (see `sort_column`) and then by id
+
+    The missing values come last. The cursor holds the value and the id of the last zone of the page, so the
+    pages stay consistent when the snapshot is refreshed between two requests.
+
+    Parameters
+        ----------
+        table : pandas.DataFrame
+            The wide table of a snapshot
+        sort : str, optional
+            The column to order by, the zones are ordered by id by default
+        descending : bool
+            The highest values first
+        limit : int, optional
+            Number of zones of the page, all of them by default
+        cursor : str, optional
+            The `next` cursor of the previous page
+
+    Return
+        ---------
+        The ids of the zones of the page in order, and the cursor of the next page (None on the last page)
+    """
+    ids = table.index.to_numpy()
+    if sort:
+        values = table[sort_column(table, sort)].astype("Float64").to_numpy(dtype=float, na_value=np.nan)
+    else:
+        values = np.zeros(len(table))
+    missing = np.isnan(values)
+    keys = np.where(missing, 0.0, -values if descending else values)
+    order = np.lexsort((ids, keys, missing))
+
+    if cursor is not None:
+        value, zone_id = decode_cursor(cursor, sort or "", descending)
+        key = 0.0 if value is None else (-value if descending else value)
+        after = (missing > (value is None)) | ((missing == (value is None)) & (
+            (keys > key) | ((keys == key) & (ids > zone_id))))
+        order = order[after[order]]
+    more = limit is not None and 0 < limit < len(order)
+    order = order[:limit]
+    next_cursor = None
+    if more:
+        last = order[-1]
+        next_cursor = encode_cursor(None if missing[last] else float(values[last]), python_values(ids[last:])[0],
+                                    sort or "", descending)
+    return table.index[order], next_cursor
+
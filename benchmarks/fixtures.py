@@ -0,0 +1,110 @@
+"""Sources of the benchmarks: recorded copies of Google Sheets and kart.trondheim.kommune.no, or synthetic ones
+
+Record the live sources once (needs network):
+    python -m benchmarks.fixtures
+"""
+import copy
+import csv
+import io
+import json
+import math
+import os
+import random
+from urllib.parse import quote
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+ZONES = 60  # number of levekårsoner of the real data
+HEADER = ["Levekårsone-nummer", "Levekårsnavn", "Antall", "Andel", "Gjennomsnittspris", "Konfidensintervall",
+          "Kommentar"]
+BOUNDS = (10.20, 63.35, 10.60, 63.47)  # lon/lat around Trondheim
+
+
+def zone_name(i: int) -> str:
+    return f"Sone {i}"
+
+
+def _number(value: int) -> str:
+    return f"{value:,}".replace(",", "\xa0")
+
+
+def synthetic_sheet(key: str, sheet: str, zones: int = ZONES) -> bytes:
+    """CSV of a sheet like the gviz export (A9:G69 of a real tab), with `zones` rows of random values"""
+    rng = random.Random(f"{key}/{sheet}")
+    out = io.StringIO()
+    writer = csv.writer(out, quoting=csv.QUOTE_ALL, lineterminator="\n")
+    writer.writerow(HEADER)
+    for i in range(1, zones + 1):
+        share = rng.uniform(0, 60)
+        writer.writerow([
+            100 + i,
+            zone_name(i),
+            _number(rng.randint(0, 5000)),
+            f"{share:.1f} %".replace(".", ",") if rng.random() > 0.02 else "",
+            _number(rng.randint(15, 60) * 100000) if rng.random() > 0.05 else "-",
+            f"{max(0.0, share - 3):.1f} - {share + 3:.1f}".replace(".", ","),
+            "",
+        ])
+    return out.getvalue().encode("utf-8")
+
+
+def synthetic_geometry(zones: int = ZONES, vertices: int = 40) -> bytes:
+    """GeoJSON of `zones` zones tiling the area around Trondheim, with about `vertices` points per side"""
+    rng = random.Random(zones)
+    columns = math.ceil(math.sqrt(zones))
+    rows = math.ceil(zones / columns)
+    width = (BOUNDS[2] - BOUNDS[0]) / columns
+    height = (BOUNDS[3] - BOUNDS[1]) / rows
+    features = []
+    for i in range(zones):
+        x0, y0 = BOUNDS[0] + (i % columns) * width, BOUNDS[1] + (i // columns) * height
+        corners = [(x0, y0), (x0 + width, y0), (x0 + width, y0 + height), (x0, y0 + height), (x0, y0)]
+        ring = []
+        for (ax, ay), (bx, by) in zip(corners, corners[1:]):
+            for k in range(vertices):
+                t = k / vertices
+                jitter = 0 if k == 0 else rng.uniform(-0.02, 0.02)
+                ring.append([ax + (bx - ax) * t + jitter * width * (by != ay),
+                             ay + (by - ay) * t + jitter * height * (bx != ax)])
+        ring.append(ring[0])
+        features.append({"type": "Feature", "properties": {"levekårsone": zone_name(i + 1)},
+                         "geometry": {"type": "Polygon", "coordinates": [ring]}})
+    return json.dumps({"type": "FeatureCollection", "features": features}).encode("utf-8")
+
+
+def scaled_sheets(sheets: dict, scale: int) -> dict:
+    """Copy of `sheets` (e.g. definition_sheets) with `scale` times more sub subjects"""
+    scaled = copy.deepcopy(sheets)
+    for subject in scaled.values():
+        subject["values"] = {f"{name} #{i}" if i else name: f"{page}-{i}" if i else page
+                             for i in range(scale) for name, page in subject["values"].items()}
+    return scaled
+
+
+def sheet_path(directory: str, key: str, sheet: str) -> str:
+    return os.path.join(directory, "sheets", key, quote(sheet, safe="") + ".csv")
+
+
+def map_path(directory: str, path: str) -> str:
+    return os.path.join(directory, "maps", *path.split("/"))
+
+
+def record(directory: str = FIXTURES_DIR):
+    """Download the live sources of the API in `directory`"""
+    from api.fetch import download, sheet_url
+    from api.function import MAPS_URL, definition_ages, definition_sheets
+
+    for subject in definition_sheets.values():
+        for sheet in subject["values"].values():
+            path = sheet_path(directory, subject["key"], sheet)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(download(sheet_url(subject["key"], sheet, "A9:G69")))
+    path = map_path(directory, definition_ages[0][len(MAPS_URL):])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(download(definition_ages[0]))
+
+
+if __name__ == "__main__":
+    record()
@@ -0,0 +1,175 @@
+"""Benchmarks of the pipeline and of the endpoints, against a local stand-in of the data sources
+
+    python -m benchmarks.run --zones 1,10,100 --sheets 1,10 --output bench.json
+
+`--zones` and `--sheets` multiply the number of zones (60) and of sheets (25), every combination is measured.
+The results are written as JSON: one entry per stage and scale with the min, median and mean time in seconds.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fixtures import ZONES, scaled_sheets
+from benchmarks.server import StandIn
+
+
+def measure(stage: str, function, repeat: int, **labels) -> dict:
+    """Run `function` `repeat` times and return the timings of `stage`"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    result = {"stage": stage, **labels, "repeat": repeat, "min": min(times), "median": statistics.median(times),
+              "mean": statistics.fmean(times)}
+    print(f"{stage:<28} {labels} median {result['median'] * 1000:10.2f} ms", file=sys.stderr)
+    return result
+
+
+def pipeline(stand_in: StandIn, zone_scale: int, sheet_scale: int, repeat: int) -> list[dict]:
+    """Measure each stage of the build of a snapshot"""
+    from api.cache import definition_cache
+    from api.function import add_geometry_column, add_properties, build_table, create_zones, definition_ages, \
+        definition_finalNames, definition_properties, definition_sheets, fetch_sheets, new_properties, parse_sheets, \
+        zone_names, zones_from_url
+    from api.responses import encode_payload
+    from api.serialize import iter_geojson
+
+    labels = {"zones": ZONES * zone_scale, "sheets": 25 * sheet_scale}
+    stand_in.zones = ZONES * zone_scale
+    sheets = scaled_sheets(definition_sheets, sheet_scale)
+    stand_in.tabs = {subject["key"]: list(subject["values"].values()) for subject in sheets.values()}
+    results = []
+
+    def cold_fetch():
+        definition_cache["directory"] = tempfile.mkdtemp(prefix="bench-cache-")
+        return fetch_sheets(sheets)
+
+    results.append(measure("fetch (cold cache)", cold_fetch, repeat, **labels))
+    raw = fetch_sheets(sheets)
+    results.append(measure("fetch (warm cache)", lambda: fetch_sheets(sheets), repeat, **labels))
+    results.append(measure("parse_sheets", lambda: parse_sheets(raw), repeat, **labels))
+    dataframes, _ = parse_sheets(raw)
+
+    def nested():
+        properties = new_properties()
+        for (subject, sub_subject), dataframe in dataframes.items():
+            add_properties(properties, dataframe, subject, sub_subject, definition_finalNames)
+        return properties
+
+    results.append(measure("add_properties", nested, repeat, **labels))
+    results.append(measure("build_table", lambda: build_table(dataframes, definition_finalNames), repeat, **labels))
+    table = build_table(dataframes, definition_finalNames)
+    geodataframe = zones_from_url(definition_ages[0])
+    properties = nested()
+    results.append(measure("add_geometry_column", lambda: add_geometry_column(dict(properties), geodataframe),
+                           repeat, **labels))
+    names = zone_names(dataframes)
+    results.append(measure("create_zones", lambda: create_zones(names, geodataframe), repeat, **labels))
+    zones = create_zones(names, geodataframe)
+    results.append(measure("serialize", lambda: encode_payload(iter_geojson(zones, table, definition_properties)),
+                           repeat, **labels))
+    return results
+
+
+def startup(repeat: int) -> list[dict]:
+    """Measure the start of a worker: a new interpreter importing `main`, and the first load of the snapshot"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    start_app = lambda: subprocess.run([sys.executable, "-c", "import main"], cwd=root, check=True)
+    # a failed load exits with an error instead of being measured
+    load = "import main, sys; main.preload(refresh=False).join(); sys.exit(main.definition_startup['error'])"
+    start_dataset = lambda: subprocess.run([sys.executable, "-c", load], cwd=root, check=True)
+    start_app()  # the first import compiles the modules
+    return [measure("startup (import main)", start_app, repeat),
+            measure("startup (import main + snapshot)", start_dataset, repeat)]
+
+
+def endpoints(stand_in: StandIn, zone_scale: int, repeat: int) -> list[dict]:
+    """Measure the endpoints of the API on a snapshot built from the stand-in"""
+    from api import snapshot
+    from api.cache import definition_cache
+    from api.function import definition_sheets
+    from main import app
+
+    labels = {"zones": ZONES * zone_scale, "sheets": 25}
+    stand_in.zones = ZONES * zone_scale
+    stand_in.tabs = {subject["key"]: list(subject["values"].values()) for subject in definition_sheets.values()}
+    definition_cache["directory"] = tempfile.mkdtemp(prefix="bench-cache-")
+    results = [measure("refresh", lambda: snapshot.publish(snapshot.build_snapshot()), 1, **labels)]
+    client = app.test_client()
+    etag = client.get("/helloworld").headers["ETag"]
+    parameters = {
+        "age_input": {"selected": ["underage (0-17)", "young adult (18-34)"], "percent": 0.3},
+        "price_input": {"selected": ["small", "medium"], "budget": 4000000},
+        "distance_input": {"posistion": [10.39628304564158, 63.433247153410214]},
+        "well_being_input": {"weight": 4},
+        "safety_input": {"weight": 2},
+        "noise_traffic_input": {"weight": 3},
+    }
+    requests = {
+        "GET /helloworld": lambda: client.get("/helloworld"),
+        "GET /helloworld gzip": lambda: client.get("/helloworld", headers={"Accept-Encoding": "gzip"}),
+        "GET /helloworld 304": lambda: client.get("/helloworld", headers={"If-None-Match": etag}),
+        "GET /helloworld?detail=low": lambda: client.get("/helloworld?detail=low"),
+        "POST /helloworld (stream)": lambda: client.post("/helloworld").get_data(),
+        "POST /ranking": lambda: client.post("/ranking", json=parameters),
+        "GET /zones/locate": lambda: client.get("/zones/locate?lon=10.39&lat=63.43"),
+    }
+    for name, send in requests.items():
+        send()  # the first request computes the data derived from the snapshot
+        results.append(measure(name, send, repeat, **labels))
+    return results
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--zones", default="1,10,100", help="Scales of the number of zones")
+    parser.add_argument("--sheets", default="1,10", help="Scales of the number of sheets")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each measure")
+    parser.add_argument("--skip-endpoints", action="store_true", help="Only measure the pipeline")
+    parser.add_argument("--output", help="File of the JSON results, stdout by default")
+    args = parser.parse_args(argv)
+
+    stand_in = StandIn()
+    work = tempfile.mkdtemp(prefix="bench-")
+    os.environ["LEVEKAR_SHEETS_URL"] = stand_in.url + "sheets/"
+    os.environ["LEVEKAR_MAPS_URL"] = stand_in.url + "maps/"
+    os.environ["LEVEKAR_CACHE_DIR"] = os.path.join(work, "cache")
+    os.environ["LEVEKAR_SNAPSHOT_DIR"] = os.path.join(work, "snapshots")
+
+    from api.function import definition_sheets
+    stand_in.tabs = {subject["key"]: list(subject["values"].values()) for subject in definition_sheets.values()}
+
+    results = []
+    try:
+        if not args.skip_endpoints:
+            results += startup(args.repeat)
+        for zone_scale in [int(s) for s in args.zones.split(",")]:
+            for sheet_scale in [int(s) for s in args.sheets.split(",")]:
+                results += pipeline(stand_in, zone_scale, sheet_scale, args.repeat)
+            if not args.skip_endpoints:
+                results += endpoints(stand_in, zone_scale, args.repeat)
+    finally:
+        stand_in.close()
+
+    report = json.dumps({
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Local stand-in for Google Sheets and kart.trondheim.kommune.no, serving the fixtures of the benchmarks"""
+import csv
+import functools
+import io
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from benchmarks.fixtures import FIXTURES_DIR, ZONES, map_path, sheet_path, synthetic_geometry, synthetic_sheet
+
+
+class StandIn:
+    """HTTP server answering the gviz sheet exports under /sheets/ and the zone geometries under /maps/
+
+    The recorded fixtures of `fixtures` are served when `zones` is the real number of zones, the synthetic ones
+    otherwise (and for the sheets that were not recorded). `zones` can be changed while the server runs.
+    The xlsx export of a spreadsheet (/sheets/<key>/export) holds the tabs listed in `tabs[key]`.
+    """
+
+    def __init__(self, zones: int = ZONES, fixtures: str = FIXTURES_DIR):
+        self.zones = zones
+        self.fixtures = fixtures
+        self.tabs = {}
+        self.requests = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real servers
+
+            def do_GET(self):
+                stand_in.requests += 1
+                url = urlsplit(self.path)
+                parts = url.path.strip("/").split("/")
+                if parts[0] == "sheets" and len(parts) >= 3 and parts[2] == "export":
+                    body = stand_in.workbook(parts[1])
+                    content_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                elif parts[0] == "sheets" and len(parts) >= 2:
+                    body = stand_in.sheet(parts[1], unquote(parse_qs(url.query).get("sheet", [""])[0]))
+                    content_type = "text/csv; charset=utf-8"
+                elif parts[0] == "maps":
+                    body = stand_in.geometry("/".join(parts[1:]))
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def _recorded(self, path: str) -> bytes | None:
+        if self.zones != ZONES or not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def sheet(self, key: str, sheet: str) -> bytes:
+        return self._recorded(sheet_path(self.fixtures, key, sheet)) or _synthetic_sheet(key, sheet, self.zones)
+
+    def workbook(self, key: str) -> bytes:
+        """xlsx export of the spreadsheet `key`, each tab holds its sheet (see `sheet`) from A9"""
+        import openpyxl
+
+        workbook = openpyxl.Workbook()
+        workbook.remove(workbook.active)
+        for tab in self.tabs.get(key, []):
+            worksheet = workbook.create_sheet(tab)
+            rows = csv.reader(io.StringIO(self.sheet(key, tab).decode("utf-8")))
+            for line, row in enumerate(rows, start=9):
+                for column, value in enumerate(row, start=1):
+                    if value != "":
+                        worksheet.cell(row=line, column=column, value=value)
+        out = io.BytesIO()
+        workbook.save(out)
+        return out.getvalue()
+
+    def geometry(self, path: str) -> bytes:
+        return self._recorded(map_path(self.fixtures, path)) or _synthetic_geometry(self.zones)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+_synthetic_sheet = functools.lru_cache(maxsize=4096)(synthetic_sheet)
+_synthetic_geometry = functools.lru_cache(maxsize=8)(synthetic_geometry)
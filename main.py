@@ -1,321 +1,420 @@
-import geopandas as gpd
-import pandas as pd
-from flask import Flask
+import sys
+import threading
+import time
+
+_started = time.perf_counter()
+
+from flask import Flask, Response, g, request
 from flask_cors import CORS
-from flask_restful import Api, Resource
+from flask_restful import Api, Resource, abort
 from flask_restful import reqparse
 
+from api.metrics import Gauge, render, request_seconds
+from api.responses import payload_response, stream_response
 
-## DEEPNOTE
+# The geo stack (pandas, geopandas, shapely, pyproj, pyarrow) is imported by the resources on their first request,
+# so a worker answers /health and /ready before it is loaded.
 
-definition_ages = [
-    "https://kart.trondheim.kommune.no/levekar2020/personer0_17/2018.js",  # 8.5
-    "https://kart.trondheim.kommune.no/levekar2020/personer18_34/2018.js",  # 26
-    "https://kart.trondheim.kommune.no/levekar2020/personer35_66/2018.js",  # 50.5
-    "https://kart.trondheim.kommune.no/levekar2020/personer67/2018.js",  # 83.5
-]
+MAX_PROFILES = 200  # profiles of a request to /ranking/batch
 
-# Instead use this we should maybe use "columnName" property of sheets
-definition_finalNames = ["Andel", "Antall", "Gjennomsnittspris"]  # , 'Konfidensintervall']
-
-definition_properties = {
-    "Levekårsone-nummer": [],
-    "Levekårsnavn": [],
-    "Ages": [],
-    "Price": [],
-    "Nærmiljø": [],
-    "geometry": []
+definition_startup = {
+    "app_seconds": None,  # import of this module and creation of the application
+    "dataset_seconds": None,  # import of the geo stack and load of the snapshot by `preload`
+    "error": None,  # last failure of `preload`
 }
 
-# Values for distribution : quantity | proportion | average | median | quintiles
-
-POPULATION = "120UjUkUfX5is20D_SX3z99vfuCHOVuN8RI1yE3-L4OM"
-ESIDENTIALENVIRONMENT = "1pU_p7FToI3VerocJXSp1-zMtWNk9SsKL_Tv7nImiXF8"
-NEARENVIRONMENT = '1s51rcfCGPpjc1hx-6B7IqC6IfBjgSR2JAwOsW9ykI3U'
-
-definition_sheets = {
-    "Ages": {
-        "key": POPULATION,
-        "values": {
-            "underage (0-17)": "1-10",
-            "young adult (18-34)": "1-40",
-            "adult (35-66)": "1-70",
-            "senior (67+)": "1-100",
-        },
-        "distribution": "proportion",
-        "inputForValues": "slider",
-        "inputSelectionValues": None,
-        "columnName": "Andel"
-    },
-    "Price": {
-        "key": ESIDENTIALENVIRONMENT,
-        "values": {
-            "small": "2-220",
-            "medium": "2-240",
-            "large": "2-260",
-        },
-        "distribution": "average",
-        "inputForValues": "slider",
-        "inputSelectionValues": "checkbox",
-        "columnName": "Gjennomsnittspris"
-    },
-    "Nærmiljø": {
-        "key": NEARENVIRONMENT,
-        "values": {
-            "trivsel-kvinner": "10-10",
-            "trivsel-menn": "10-20",
-            "trygghet-kvinner": "10-30",
-            "trygghet-menn": "10-40",
-            "tilgjengelighet kultur-kvinner": "10-50",
-            "tilgjengelighet kultur-menn": "10-60",
-            "tilgjengelighet friluftsområder-kvinner": "10-90",
-            "tilgjengelighet friluftsområder-menn": "10-100",
-            "tilgjengelighet offentlig transport-kvinner": "10-110",
-            "tilgjengelighet offentlig transport-menn": "10-120",
-            "tilgjengelighet butikker-kvinner": "10-130",
-            "tilgjengelighet butiker-menn": "10-140",
-            "tilgjengelighet gang og sykkelvei-kvinner": "10-150",
-            "tilgjengelighet gang og sykkelvei-menn": "10-160",
-            "plaget av trafikk støy-kvinner": "10-170",
-            "plaget av trafikk støy-menn": "10-180",
-            "plaget av annen støy-kvinner": "10-190",
-            "plaget av annen støy-menn": "10-200",
-
-        },
-        "distribution": "proportion",
-        "inputForValues": "slider",
-        "inputSelectionValues": None,
-        "columnName": "Andel"
-    },
-}
+Gauge("levekar_startup_seconds", "Time to import the API and create the application",
+      function=lambda: definition_startup["app_seconds"])
+Gauge("levekar_dataset_load_seconds", "Time to import the geo stack and load the snapshot at startup",
+      function=lambda: definition_startup["dataset_seconds"])
 
-function_converters = {
-    'Andel': lambda s: percent_to_float(s),
-    'Gjennomsnittspris': lambda s: string_to_int(s)
-}
 
+def start_timer():
+    g.start = time.perf_counter()
 
-def percent_to_float(s: str) -> float:
-    if s == "":
-        return 0.0
-    s = s.strip("%")
-    s = s.replace(',', '.')
-    return round(float(s) / 100, 2)
-
-
-def string_to_int(s: str) -> None | int:
-    res = s.replace("\xa0", '')
-    if not res.isdigit():
-        return None
-    return int(res)
-
-
-def data_from_sheet(key: str, sheet: str, start_column: chr, start_line: int, end_column: chr, end_line: int,
-                    names: list = None, converters: dict = None) -> pd.DataFrame:
-    df = pd.read_csv('https://docs.google.com/spreadsheets/d/' +
-                     key +
-                     '/gviz/tq?tqx=out:csv&range=' + start_column + str(start_line) + ':' + end_column + str(end_line) +
-                     '&sheet=' +
-                     sheet,
-                     names=names,
-                     converters=converters
-                     )
-    df.columns = df.columns.str.replace('\n', '')
-    return df
-
-
-def add_properties(properties: dict, dataframe: pd.DataFrame, subject: str, sub_subject: str,
-                   final_names=None) -> dict:
-    """Add data from DataFrame to the argument `properties`, e.g.: properties.subject.subSubject
-
-    A `properties` dictionary like this:
-    properties = {
-        "id": [],
-        "name": [],
-        "A_Subject": [],
-        "geometry": []
-    }
-
-    A DataFrame like this:
-    index |   id,   name,   average,   useless_data|
-    -----------------------------------------------|
-        0 | id_0, name_0, average_0, useless_data_0|
-        1 | id_1, name_1, average_1, useless_data_1|
-        2 | id_2, name_2, average_2, useless_data_2|
-        3 | id_3, name_3, average_3, useless_data_3|
-
-    Call the function like this: add_properties(properties, dataframe, "A_Subject", "A_Subsubject", ["average"] )
-
-    Result:
-    properties = {
-        "id": [id_0, id_1, id_2, id_3],
-        "name": [name_0, name_1, name_2, name_3],
-        "A_Subject": [
-            {
-                "A_Subsubject": {"average": average_0}
-            },
-            {
-                "A_Subsubject": {"average": average_1}
-            },
-            {
-                "A_Subsubject": {"average": average_2}
-            },
-            {
-                "A_Subsubject": {"average": average_3}
-            }
-        ],
-        "geometry": []
-    }
 
-    Parameters
-        ----------
-        properties : dict
-            Dictionary used for generate the GeoDataFrame, it contains all data and the `geometry` column
-        dataframe : pandas.DataFrame
-            Data to add to the `properties` dictionary
-        subject : str
-            Subject used as name of column (e.g. Befolkning)
-        sub_subject : str
-            Subsbuject used to categorize subjects within a larger
-        final_names : list
-            The final data to keep
+def observe_request(response):
+    if "start" in g:
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unknown"
+        request_seconds.observe(time.perf_counter() - g.start, endpoint=endpoint, method=request.method,
+                                status=response.status_code)
+    return response
 
-    Return
-        ---------
-        A Dictionary fill with data
-    """
 
-    if final_names is None:
-        final_names = []
-    for columnName in dataframe:
-        if columnName in properties.keys():
-            if len(properties[columnName]) == 0: properties[columnName] = dataframe[columnName].to_list()
-        elif len(final_names) == 0 or columnName in final_names:
-            values = dataframe[columnName].to_list()
-            for i in range(len(values)):
-                if len(properties[subject]) <= i:
-                    properties[subject].append({sub_subject: {columnName: values[i]}})
-                elif sub_subject not in properties[subject][i].keys():
-                    properties[subject][i][sub_subject] = {columnName: values[i]}
-                else:
-                    properties[subject][i][sub_subject][columnName] = values[i]
-    return properties
-
-
-def add_geometry_column(properties: dict, geodataframe: gpd.GeoDataFrame, id_property: str = "Levekårsnavn",
-                        id_geo: str = "levekårsone") -> dict:
-    """Add data to `geometry` column
-
-    Fill the `geometry` column of the `properties` dictionary with the geometry data of `geodataframe`.
-    Use the `idProperty` and `idGeo` to match data and geometry
-
-    A `properties` dictionary like this:
-    properties = {
-        "id": [id_0, id_1, id_2, id_3],
-        "geometry": []
-    }
-
-    A GeoDataFrame like this:
-    index | special_id, ...data...,   geometry|
-    ------------------------------------------|
-        0 |       id_0, ...data..., geometry_0|
-        1 |       id_1, ...data..., geometry_1|
-        2 |       id_2, ...data..., geometry_2|
-        3 |       id_3, ...data..., geometry_3|
-
-    Call the function like this: add_geometry_column(properties, geodataframe, "id", "special_id" )
-
-    Result:
-    properties = {
-        "id": [id_0, id_1, id_2, id_3],
-        "geometry": [geometry_0, geometry_1, geometry_2, geometry_3]
-    }
+def metrics():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def current_snapshot():
+    """The published snapshot, 503 while a worker waits for the loader to publish the first one"""
+    from api.snapshot import SnapshotUnavailable, current_snapshot as published
+
+    try:
+        return published()
+    except SnapshotUnavailable as e:
+        abort(503, message=str(e))
+
+
+def loaded_snapshot():
+    """The published snapshot, None if it is not loaded yet (without importing the geo stack)"""
+    module = sys.modules.get("api.snapshot")
+    return module.loaded_snapshot() if module is not None else None
+
+
+def preload(refresh: bool = True) -> threading.Thread:
+    """Load the snapshot in a background thread, then refresh it periodically if `refresh`"""
+    def run():
+        start = time.perf_counter()
+        try:
+            from api.snapshot import current_snapshot, start_refresher
+            current_snapshot()
+        except Exception as e:
+            definition_startup["error"] = repr(e)
+            print(f"Load of the dataset failed: {e!r}")
+        else:
+            definition_startup["dataset_seconds"] = time.perf_counter() - start
+            definition_startup["error"] = None
+        if refresh:
+            start_refresher()
+
+    thread = threading.Thread(target=run, name="snapshot-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def detail_argument() -> str:
+    from api.tiles import definition_details
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('detail', default='full', choices=list(definition_details), location='args',
+                        help='Level of detail of the geometries')
+    return parser.parse_args()['detail']
 
-    Parameters
-        ----------
-        properties : dict
-            Dictionary used for generate the GeoDataFrame, it contains all data and the `geometry` column
-        geodataframe : geopandas.GeoDataFrame
-            GeoDataFrame with all data for the `geometry` column
-        id_property : str, optional
-            The id column used in the `properties` dictionary
-        id_geo : str, optional
-            The id column used in the GeoDataFrame object
-    Return
-        ---------
-        A Dictionary fill with geometry data
-    """
-    for name in properties[id_property]:
-        for j in range(len(geodataframe[id_geo])):
-            if name == geodataframe[id_geo][j]:
-                properties["geometry"].append(geodataframe["geometry"][j])
-    return properties
 
+def fields_argument(value: str) -> list | None:
+    """The subjects and sub subjects of a `fields` argument separated by commas, None when there is none"""
+    fields = [field.strip() for field in value.split(",") if field.strip()] if value else []
+    return fields or None
 
-def create_geojson_file(properties: dict, sheets: dict, geodataframe: gpd.GeoDataFrame, final_names: list[str],
-                        converters: dict) -> gpd.GeoDataFrame:
-    for subject in sheets.keys():
-        for subSubject, page in sheets[subject]["values"].items():
-            dataframe = data_from_sheet(sheets[subject]["key"], page, 'A', 9, 'G', 69, converters=converters)
-            properties = add_properties(properties, dataframe, subject, subSubject, final_names)
-    properties = add_geometry_column(properties, geodataframe)
-    return gpd.GeoDataFrame(properties, crs="urn:ogc:def:crs:OGC:1.3:CRS84")
 
+def dataset_response(snapshot, detail: str) -> Response:
+    """The GeoJSON document of `snapshot`, with its version for /changes"""
+    from api.snapshot import payload
 
-## END DEEPNOTE
+    response = payload_response(payload(snapshot, detail))
+    response.headers["X-Dataset-Version"] = str(snapshot.version)
+    return response
 
-app = Flask(__name__)
-api = Api(app)
-CORS(app)
+
+class Health(Resource):
+    @staticmethod
+    def get():
+        return {"status": "ok"}
+
+
+class Ready(Resource):
+    @staticmethod
+    def get():
+        snapshot = loaded_snapshot()
+        result = {"ready": snapshot is not None, **definition_startup}
+        if snapshot is None:
+            return result, 503
+        return dict(result, version=snapshot.version, built_at=snapshot.built_at)
 
 
 class HelloWorld(Resource):
     @staticmethod
     def get():
-        age0_17 = gpd.read_file(definition_ages[0])
-        gdf = create_geojson_file(definition_properties, definition_sheets, age0_17, definition_finalNames,
-                                  function_converters)
-        test = gdf.to_json()
-        test = test.replace('NaN', 'null')
-        f = open('data2.geojson', 'w')
-        f.write(test)
-        # gdf.to_file("data2.geojson", driver='GeoJSON', engine='fiona', encoding='utf-8')
-        return test
+        return dataset_response(current_snapshot(), detail_argument())
 
     @staticmethod
     def post():
-        return gpd.read_file('data2.geojson', engine='fiona', encoding='utf-8').to_json()
+        from api.snapshot import geojson_chunks
+
+        snapshot = current_snapshot()
+        return stream_response(geojson_chunks(snapshot.zones, snapshot.table))
 
 class HelloWorld2(Resource):
+    @staticmethod
+    def get():
+        return dataset_response(current_snapshot(), detail_argument())
+
+    @staticmethod
+    def post():
+        from api.snapshot import geojson_chunks
+
+        snapshot = current_snapshot()
+        return stream_response(geojson_chunks(snapshot.zones, snapshot.table))
+
+
+class Zones(Resource):
+    @staticmethod
+    def get():
+        parser = reqparse.RequestParser()
+        parser.add_argument('fields', location='args',
+                            help='Subjects and sub subjects separated by commas, e.g. Ages,Price/small')
+        parser.add_argument('geometry', type=int, default=1, location='args', help='0 to leave out the geometries')
+        parser.add_argument('sort', location='args', help='Measure to order by, e.g. Price/small')
+        parser.add_argument('order', default='desc', choices=['asc', 'desc'], location='args',
+                            help='asc or desc')
+        parser.add_argument('limit', type=int, location='args', help='Number of zones of a page')
+        parser.add_argument('cursor', location='args', help='The next cursor of the previous page')
+        args = parser.parse_args()
+        detail = detail_argument()
+
+        from api.function import ID_COLUMN, NAME_COLUMN
+        from api.serialize import iter_geojson
+        from api.snapshot import detail_zones
+        from api.zones import page, select_columns
+
+        if args['limit'] is not None and args['limit'] < 1:
+            abort(400, message="limit must be at least 1")
+        snapshot = current_snapshot()
+        fields = fields_argument(args['fields'])
+        try:
+            table = select_columns(snapshot.table, fields)
+            ids, next_cursor = page(snapshot.table, args['sort'], args['order'] == 'desc', args['limit'],
+                                    args['cursor'])
+        except ValueError as e:
+            abort(400, message=str(e))
+        columns = [ID_COLUMN, NAME_COLUMN] + list(dict.fromkeys(table.columns.get_level_values(0)))
+        if args['geometry']:
+            columns.append("geometry")
+        zones = detail_zones(snapshot, detail) if args['geometry'] else snapshot.zones
+        return stream_response(iter_geojson(zones, table.loc[ids], columns,
+                                            members={"version": snapshot.version, "next": next_cursor}))
+
+
+class Changes(Resource):
+    @staticmethod
+    def get():
+        parser = reqparse.RequestParser()
+        parser.add_argument('since', type=int, required=True, location='args',
+                            help='Version of the dataset of the client')
+        args = parser.parse_args()
+
+        from api.snapshot import changes
+
+        snapshot = current_snapshot()
+        delta = changes(snapshot, args['since'])
+        if delta is None:
+            abort(410, message="Version {} is not available anymore, download /helloworld".format(args['since']))
+        return payload_response(delta)
+
+
+class Stats(Resource):
+    @staticmethod
+    def get():
+        parser = reqparse.RequestParser()
+        parser.add_argument('fields', location='args',
+                            help='Subjects and sub subjects separated by commas, e.g. Ages,Price/small')
+        parser.add_argument('zones', type=int, default=0, location='args',
+                            help='1 to add the z-scores and the quintile ranks of every zone')
+        args = parser.parse_args()
+
+        from api.snapshot import derived
+        from api.stats import build_stats, describe
+
+        snapshot = current_snapshot()
+        stats = derived(snapshot, "stats", lambda s: build_stats(s.table))
+        fields = fields_argument(args['fields'])
+        try:
+            result = {"version": snapshot.version, "measures": describe(stats, fields, bool(args['zones']))}
+        except ValueError as e:
+            abort(400, message=str(e))
+        if args['zones']:
+            result["zones"] = stats["ids"]
+        return result
+
+
+class TimeSeries(Resource):
+    @staticmethod
+    def get(kind='values'):
+        parser = reqparse.RequestParser()
+        parser.add_argument('from', type=int, location='args', help='First year')
+        parser.add_argument('to', type=int, location='args', help='Last year')
+        parser.add_argument('fields', location='args',
+                            help='Subjects and sub subjects separated by commas, e.g. Ages,Price/small')
+        parser.add_argument('zones', location='args', help='Ids of the zones separated by commas')
+        args = parser.parse_args()
+
+        from api.timeseries import current_cube, select
+
+        cube = current_cube()
+        if cube is None:
+            abort(404, message="No time series was recorded yet")
+        fields = fields_argument(args['fields'])
+        try:
+            zones = [int(zone) for zone in args['zones'].split(",") if zone.strip()] if args['zones'] else None
+            return select(cube, args['from'], args['to'], fields, zones, deltas=kind == 'deltas')
+        except ValueError as e:
+            abort(400, message=str(e))
+
+
+class Refresh(Resource):
+    @staticmethod
+    def post():
+        from api.snapshot import SnapshotUnavailable, refresh_snapshot, thaw
+
+        try:
+            snapshot = refresh_snapshot()
+        except SnapshotUnavailable as e:
+            abort(503, message=str(e))
+        return {"version": snapshot.version, "built_at": snapshot.built_at, "changelog": thaw(snapshot.changelog)}
+
+
+class Ranking(Resource):
     @staticmethod
     def post():
         parser = reqparse.RequestParser()
-        parser.add_argument('Ages', type=int, help='Avarehe age of the people')
-        parser.add_argument('Prices', type=int, help='Prices in the area')
-        parser.add_argument('Nærmiljø', type=int, help='Nærmiljø')
+        parser.add_argument('top_k', type=int, location='args', help='Number of zones to return')
         args = parser.parse_args()
 
+        from api.scoring import check_parameters
+
+        parameters = request.get_json(force=True)
+        try:
+            check_parameters(parameters)
+        except ValueError as error:
+            abort(400, message=str(error))
 
-        age0_17 = gpd.read_file(definition_ages[0])
-        gdf = create_geojson_file(definition_properties, definition_sheets, age0_17, definition_finalNames,
-                                  function_converters)
-        test = gdf.to_json()
-        test = test.replace('NaN', 'null')
-        f = open('data2.geojson', 'w')
-        f.write(test)
-        # gdf.to_file("data2.geojson", driver='GeoJSON', engine='fiona', encoding='utf-8')
-        return test
+        snapshot = current_snapshot()
+        return {"version": snapshot.version, "zones": rankings(snapshot, [parameters], args['top_k'])[0]}
 
+
+class RankingBatch(Resource):
     @staticmethod
     def post():
-        return gpd.read_file('data2.geojson', engine='fiona', encoding='utf-8').to_json()
+        parser = reqparse.RequestParser()
+        parser.add_argument('top_k', type=int, location='args', help='Number of zones to return for each profile')
+        args = parser.parse_args()
 
+        from api.scoring import check_parameters
 
+        body = request.get_json(force=True)
+        profiles = body.get("profiles") if isinstance(body, dict) else body
+        if not isinstance(profiles, list) or not all(isinstance(p, dict) for p in profiles):
+            abort(400, message="Expected a list of profiles shaped like PARAMETERS")
+        if len(profiles) > MAX_PROFILES:
+            abort(400, message="At most {} profiles per request".format(MAX_PROFILES))
+        for i, parameters in enumerate(profiles):
+            try:
+                check_parameters(parameters)
+            except ValueError as error:
+                abort(400, message="Profile {}: {}".format(i, error))
 
+        snapshot = current_snapshot()
+        return {"version": snapshot.version, "rankings": rankings(snapshot, profiles, args['top_k'])}
 
-api.add_resource(HelloWorld, "/helloworld")
-api.add_resource(HelloWorld2, "/helloworld2")
+
+class Locate(Resource):
+    @staticmethod
+    def get():
+        parser = reqparse.RequestParser()
+        parser.add_argument('lon', type=float, required=True, location='args', help='Longitude (WGS84)')
+        parser.add_argument('lat', type=float, required=True, location='args', help='Latitude (WGS84)')
+        parser.add_argument('distances', type=int, default=0, location='args',
+                            help='1 to add the distance to every zone')
+        args = parser.parse_args()
+
+        from api.spatial import nearest_zone, zone_containing, zone_distances
+
+        snapshot = current_snapshot()
+        index = spatial_index(snapshot)
+        zone = lambda i: {"Levekårsone-nummer": index["ids"][i], "Levekårsnavn": index["names"][i]}
+        inside = zone_containing(index, args['lon'], args['lat'])
+        nearest = nearest_zone(index, args['lon'], args['lat'])
+        result = {
+            "version": snapshot.version,
+            "contains": zone(inside) if inside is not None else None,
+            "nearest": dict(zone(nearest[0]), distance=round(nearest[1], 1)) if nearest is not None else None,
+        }
+        if args['distances']:
+            distances = zone_distances(index, args['lon'], args['lat'])
+            result["distances"] = [dict(zone(i), distance=round(float(distances[i]), 1))
+                                   for i in distances.argsort() if distances[i] == distances[i]]
+        return result
+
+
+class Tile(Resource):
+    @staticmethod
+    def get(z, x, y):
+        from api.snapshot import tiles
+        from api.tiles import MAX_ZOOM, tile
+
+        if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+            abort(404, message="Tile {}/{}/{} doesn't exist".format(z, x, y))
+        return Response(tile(tiles(current_snapshot()), z, x, y), mimetype='application/vnd.mapbox-vector-tile')
+
+
+def scoring_model(snapshot) -> dict:
+    """The scoring model of `snapshot` (see `build_model`)"""
+    from api.scoring import build_model
+    from api.snapshot import derived
+
+    return derived(snapshot, "scoring", lambda s: build_model(s.table, s.zones["Levekårsnavn"]))
+
+
+def rankings(snapshot, profiles: list, top_k: int = None) -> list[list[dict]]:
+    """The ranking of the zones of `snapshot` for each of `profiles`, through the cache of the rankings"""
+    from api.scoring import cached_rankings
+    from api.spatial import zone_distances
+
+    return cached_rankings(snapshot.version, lambda: scoring_model(snapshot), profiles, top_k,
+                           lambda lon, lat: zone_distances(spatial_index(snapshot), lon, lat))
+
+
+def spatial_index(snapshot) -> dict:
+    """The spatial index of the zones of `snapshot`, in the order of its table"""
+    from api.snapshot import derived
+    from api.spatial import build_index
+
+    return derived(snapshot, "spatial", lambda s: build_index(s.zones.reindex(s.table.index)))
+
+
+def create_app(preload_dataset: bool = False) -> Flask:
+    """Create the application, the snapshot is loaded by the first request or in the background if `preload_dataset`
+
+    Parameters
+        ----------
+        preload_dataset : bool
+            Load the snapshot and start its refresher in a background thread
+
+    Return
+        ---------
+        The Flask application
+    """
+    app = Flask(__name__)
+    api = Api(app)
+    CORS(app, expose_headers=["ETag", "X-Dataset-Version"])
+    app.before_request(start_timer)
+    app.after_request(observe_request)
+    app.add_url_rule("/metrics", view_func=metrics)
+
+    api.add_resource(Health, "/health")
+    api.add_resource(Ready, "/ready")
+    api.add_resource(HelloWorld, "/helloworld")
+    api.add_resource(HelloWorld2, "/helloworld2")
+    api.add_resource(Zones, "/zones")
+    api.add_resource(Changes, "/changes")
+    api.add_resource(Stats, "/stats")
+    api.add_resource(TimeSeries, "/timeseries", "/timeseries/<any(deltas):kind>")
+    api.add_resource(Refresh, "/refresh")
+    api.add_resource(Ranking, "/ranking")
+    api.add_resource(RankingBatch, "/ranking/batch")
+    api.add_resource(Locate, "/zones/locate")
+    api.add_resource(Tile, "/tiles/<int:z>/<int:x>/<int:y>.pbf")
+
+    if preload_dataset:
+        preload()
+    if definition_startup["app_seconds"] is None:
+        definition_startup["app_seconds"] = time.perf_counter() - _started
+    return app
+
+
+app = create_app()
 
 if __name__ == "__main__":
     # print(gpd.read_file("data2.geojson", engine='fiona', encoding='utf-8'))
+    preload()
     app.run(debug=True)
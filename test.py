@@ -3,4 +3,10 @@ import requests
 BASE = "http://127.0.0.1:5000/"
 
 response = requests.get(BASE + "helloworld")
-print(response.json())
\ No newline at end of file
+print(response.json())
+
+# On a fresh snapshot each level of detail builds its payload from the simplified zones, both derived data
+for detail in ("low", "medium", "high"):
+    response = requests.get(BASE + "helloworld", params={"detail": detail}, timeout=120)
+    response.raise_for_status()
+    print(detail, len(response.content))